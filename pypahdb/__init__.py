@@ -78,6 +78,19 @@ when using pypahdb:
       https://doi.org/10.3847/1538-4365/abc2c8
 """
 
-from . import _version
 
-__version__ = _version.get_versions()["version"]
+def __getattr__(name):
+    """Resolve the version on first access rather than at import.
+
+    In a source checkout versioneer may have to run git to determine the
+    version, which should not slow down every import of pypahdb.
+    """
+    if name == "__version__":
+        from . import _version
+
+        version = _version.get_versions()["version"]
+        globals()["__version__"] = version
+
+        return version
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
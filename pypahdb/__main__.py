@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+"""
+__main__.py
+
+Allows running the command-line interface as `python -m pypahdb`.
+
+This file is part of pypahdb - see the module docs for more
+information.
+"""
+import sys
+
+from pypahdb.cli import main
+
+sys.exit(main())
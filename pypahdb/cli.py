@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+cli.py
+
+Command-line driver that decomposes many observations, overlapping
+reading, fitting and writing.
+
+This file is part of pypahdb - see the module docs for more
+information.
+"""
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+
+from pypahdb.decomposer import Decomposer
+from pypahdb.decomposer_base import _decomposer_pool, set_thread_budget
+from pypahdb.observation import Observation
+
+EXTENSIONS = (".fits", ".fit", ".fts", ".tbl", ".ipac", ".txt", ".dat")
+
+SUFFIX = "_pypahdb"
+
+_DONE = object()
+
+
+def _expand(paths):
+    """Expand directories into the observation files they contain."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                stem, ext = os.path.splitext(name)
+                if ext.lower() in EXTENSIONS and not stem.endswith(SUFFIX):
+                    files.append(os.path.join(path, name))
+        else:
+            files.append(path)
+
+    return files
+
+
+def _outputs(files, output_dir=None):
+    """Return the output path, without extension, for each file.
+
+    Files sharing a name but not an extension keep their extension in
+    the output name, and files sharing both, e.g., from different input
+    directories written to the same output directory, also get the name
+    of their parent directory.
+
+    Raises:
+        ValueError: When output names still collide.
+    """
+    names = {}
+    for f in files:
+        directory = output_dir if output_dir else os.path.dirname(f)
+        stem, ext = os.path.splitext(os.path.basename(f))
+        parent = os.path.basename(os.path.dirname(os.path.abspath(f)))
+        names[f] = [directory, stem, ext, parent]
+
+    def _collisions():
+        counts = {}
+        for directory, stem, _, _ in names.values():
+            key = os.path.join(directory, stem)
+            counts[key] = counts.get(key, 0) + 1
+        return [
+            f for f, (directory, stem, _, _) in names.items()
+            if counts[os.path.join(directory, stem)] > 1
+        ]
+
+    for f in _collisions():
+        names[f][1] = f"{names[f][1]}_{names[f][2].lstrip('.')}"
+    for f in _collisions():
+        names[f][1] = f"{names[f][3]}_{names[f][1]}"
+    collisions = _collisions()
+    if collisions:
+        raise ValueError(f"output names collide for {', '.join(collisions)}")
+
+    return {
+        f: os.path.join(directory, stem) + SUFFIX
+        for f, (directory, stem, _, _) in names.items()
+    }
+
+
+def run(
+    paths,
+    output_dir=None,
+    version=None,
+    pdf=False,
+    doplots=False,
+    workers=1,
+    queue_size=2,
+):
+    """Decompose observations in a read, fit and write pipeline.
+
+    Reading and writing run in threads, so reading the next and writing
+    the previous observations overlap with fitting the current one. The
+    queues between the stages are bounded to limit memory use.
+
+    Args:
+        paths (list): Files and/or directories to decompose.
+
+    Keywords:
+        output_dir (str): Directory to write to (defaults to the
+            directory of each input file).
+        version (str): The version of the precomputed matrix to use.
+        pdf (bool): Also write a PDF summary (defaults to False).
+        doplots (bool): Plot each pixel's fit in the PDF (defaults to
+            False).
+        workers (int): Number of reader and of writer threads (defaults
+            to 1).
+        queue_size (int): Maximum number of observations waiting between
+            stages (defaults to 2).
+
+    Returns:
+        list: A summary for each file with the timings in seconds of the
+        stages and the error, if any.
+
+    Raises:
+        ValueError: When the output names of files collide.
+    """
+    files = _expand(paths)
+    outputs = _outputs(files, output_dir)
+    summary = {
+        f: {"file": f, "read": None, "fit": None, "write": None, "error": None}
+        for f in files
+    }
+
+    if pdf:
+        # pyplot is neither thread-safe nor needs a display here.
+        import matplotlib
+
+        matplotlib.use("Agg")
+    pdf_lock = threading.Lock()
+
+    pending = queue.Queue()
+    for f in files:
+        pending.put(f)
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+
+    def _reader():
+        while True:
+            try:
+                f = pending.get_nowait()
+            except queue.Empty:
+                break
+            t = time.perf_counter()
+            try:
+                obs = Observation(f)
+            except Exception as e:
+                summary[f]["error"] = f"read: {e}"
+                obs = None
+            summary[f]["read"] = time.perf_counter() - t
+            read_queue.put((f, obs))
+        read_queue.put(_DONE)
+
+    def _writer():
+        while True:
+            item = write_queue.get()
+            if item is _DONE:
+                break
+            f, obs, result = item
+            t = time.perf_counter()
+            try:
+                stem = outputs[f]
+                result.save_fits(f"{stem}.fits", header=obs.header)
+                if pdf:
+                    with pdf_lock:
+                        result.save_pdf(
+                            f"{stem}.pdf", header=obs.header, doplots=doplots
+                        )
+            except Exception as e:
+                summary[f]["error"] = f"write: {e}"
+            summary[f]["write"] = time.perf_counter() - t
+
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    # Fork the fitting processes before starting any threads.
+    _decomposer_pool()
+
+    workers = max(1, workers)
+    readers = [threading.Thread(target=_reader, daemon=True) for _ in range(workers)]
+    writers = [threading.Thread(target=_writer, daemon=True) for _ in range(workers)]
+    for thread in readers + writers:
+        thread.start()
+
+    # Fit in the main thread, which uses the shared process pool.
+    done = 0
+    while done < len(readers):
+        item = read_queue.get()
+        if item is _DONE:
+            done += 1
+            continue
+        f, obs = item
+        if obs is None:
+            continue
+        t = time.perf_counter()
+        try:
+            result = Decomposer(obs.spectrum, version=version)
+            if not hasattr(result, "_weights"):
+                raise ValueError("nothing to fit")
+        except Exception as e:
+            summary[f]["error"] = f"fit: {e}"
+            result = None
+        summary[f]["fit"] = time.perf_counter() - t
+        if result is not None:
+            write_queue.put((f, obs, result))
+
+    for _ in writers:
+        write_queue.put(_DONE)
+    for thread in writers:
+        thread.join()
+
+    return [summary[f] for f in files]
+
+
+def _print_summary(summary, file=sys.stdout):
+    """Print the timings and failures of each file."""
+
+    def _fmt(value):
+        return f"{value:9.3f}" if value is not None else f"{'-':>9}"
+
+    print("-" * 80, file=file)
+    print(
+        f"{'FILE':<40.40s} {'READ [s]':>9} {'FIT [s]':>9} {'WRITE [s]':>9}  STATUS",
+        file=file,
+    )
+    print("-" * 80, file=file)
+    for s in summary:
+        status = "ok" if s["error"] is None else "failed"
+        print(
+            f"{os.path.basename(s['file']):<40.40s} {_fmt(s['read'])} "
+            f"{_fmt(s['fit'])} {_fmt(s['write'])}  {status}",
+            file=file,
+        )
+    print("-" * 80, file=file)
+    for s in summary:
+        if s["error"] is not None:
+            print(f"{s['file']}: {s['error']}", file=file)
+
+
+def main(argv=None):
+    """Run the pypahdb command-line interface.
+
+    Args:
+        argv (list): Command-line arguments (defaults to sys.argv[1:]).
+
+    Returns:
+        int: The exit status, 1 when any file failed.
+    """
+    parser = argparse.ArgumentParser(
+        prog="pypahdb",
+        description="Decompose astronomical PAH spectra using the NASA Ames "
+        "PAH IR Spectroscopic Database.",
+    )
+    parser.add_argument("paths", nargs="+", help="files and/or directories")
+    parser.add_argument("-o", "--output-dir", help="directory to write to")
+    parser.add_argument(
+        "-m", "--matrix-version", help="version of the precomputed matrix"
+    )
+    parser.add_argument("--pdf", action="store_true", help="also write a PDF")
+    parser.add_argument(
+        "--doplots", action="store_true", help="plot each pixel's fit in the PDF"
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, default=1, help="reader and writer threads"
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=2, help="observations between stages"
+    )
+    parser.add_argument(
+        "--processes", type=int, help="fitting processes (defaults to CPUs - 1)"
+    )
+    parser.add_argument(
+        "--blas-threads", type=int, help="BLAS/OpenMP threads per fitting process"
+    )
+    args = parser.parse_args(argv)
+
+    set_thread_budget(args.processes, args.blas_threads)
+    try:
+        summary = run(
+            args.paths,
+            output_dir=args.output_dir,
+            version=args.matrix_version,
+            pdf=args.pdf,
+            doplots=args.doplots,
+            workers=args.workers,
+            queue_size=args.queue_size,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    _print_summary(summary)
+
+    return int(any(s["error"] is not None for s in summary))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,28 +8,43 @@ information.
 
 """
 import copy
+import hashlib
+import json
 import sys
 import warnings
 from datetime import datetime, timezone
 from functools import cached_property
 
-import matplotlib.gridspec as gridspec
-import matplotlib.pyplot as plt
 import numpy as np
+from astropy import units as u
 from astropy.io import fits
-from astropy.wcs import WCS
-from matplotlib import cm, colormaps, colors
-from matplotlib.backends.backend_pdf import PdfPages
-from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 
 import pypahdb
-from pypahdb.decomposer_base import MEDIUM_SIZE, SMALL_SIZE, DecomposerBase
+from pypahdb.decomposer_base import (
+    MEDIUM_SIZE,
+    SMALL_SIZE,
+    DecomposerBase,
+    _decomposer_convert,
+    _decomposer_load,
+    _decomposer_matrix,
+    spectral_fingerprint,
+)
 
 
 class Decomposer(DecomposerBase):
     """Extends DecomposerBase to write results to disk (PDF, FITS)."""
 
-    def __init__(self, spectrum, version=None):
+    def __init__(
+        self,
+        spectrum,
+        version=None,
+        cache=None,
+        dtype=np.float64,
+        weighted=False,
+        uncertainties=False,
+        solver="nnls",
+        solver_options=None,
+    ):
         """Initialize Decomposer object.
 
         Inherits from DecomposerBase defined in decomposer_base.py.
@@ -37,8 +52,30 @@ class Decomposer(DecomposerBase):
         Args:
             spectrum (specutils.Spectrum): The data to fit/decompose.
             version (str): The version of the precomputed matrix to use.
+            cache (ResultCache): Optional, cache of fitted weights.
+            dtype (numpy.dtype): The dtype of the interpolated matrix, the
+                weights and the spectral breakdowns (defaults to
+                numpy.float64).
+            weighted (bool): Weight the fit by the uncertainty of the
+                spectrum (defaults to False).
+            uncertainties (bool): Propagate the covariance of the fit to
+                the uncertainties of the fractions and the average number
+                of carbon atoms (defaults to False).
+            solver (str): The solver, either 'nnls', 'qr', 'pg' or
+                'reduced' (defaults to 'nnls').
+            solver_options (dict): Optional, the options of the solver.
         """
-        DecomposerBase.__init__(self, spectrum, version=version)
+        DecomposerBase.__init__(
+            self,
+            spectrum,
+            version=version,
+            cache=cache,
+            dtype=dtype,
+            weighted=weighted,
+            uncertainties=uncertainties,
+            solver=solver,
+            solver_options=solver_options,
+        )
 
     @cached_property
     def cation_neutral_ratio(self):
@@ -51,6 +88,139 @@ class Decomposer(DecomposerBase):
 
         return cation_neutral_ratio
 
+    def save_state(self, filename, spectrum=True):
+        """Save the state of the decomposition to reload it without
+        refitting.
+
+        The state is a compressed NumPy .npz-file holding the non-zero
+        weights as float32, the mask, the version of the precomputed
+        matrix, hashes of the spectral grid and the interpolated matrix,
+        and, optionally, the observed flux and uncertainty as float32.
+
+        Args:
+            filename (str): Path to save to.
+
+        Keywords:
+            spectrum (bool): Save the observed flux and uncertainty,
+                otherwise the spectrum needs to be passed to load_state
+                (defaults to True).
+        """
+        weights = self._weights.ravel()
+        nonzero = np.flatnonzero(weights)
+
+        state = {
+            "weights_index": nonzero.astype(np.int64),
+            "weights_value": weights[nonzero].astype(np.float32),
+            "weights_shape": np.array(self._weights.shape),
+            "mask": self._mask,
+            "version": str(self._precomputed.get("version", "")),
+            "dtype": str(self._matrix.dtype),
+            "weighted": self._weighted,
+            "settings": json.dumps(self._settings),
+            "grid_hash": spectral_fingerprint(self.spectrum.spectral_axis),
+            "matrix_hash": hashlib.sha1(
+                np.ascontiguousarray(self._matrix).tobytes()
+            ).hexdigest(),
+        }
+        if spectrum:
+            state.update(
+                {
+                    "abscissa": self.spectrum.spectral_axis.value,
+                    "abscissa_unit": str(self.spectrum.spectral_axis.unit),
+                    "flux": self.spectrum.flux.value.astype(np.float32),
+                    "flux_unit": str(self.spectrum.flux.unit),
+                    "colnames": np.array(
+                        self.spectrum.meta.get("colnames", 3 * [""])
+                    ),
+                }
+            )
+            if self.spectrum.uncertainty is not None:
+                state["uncertainty"] = self.spectrum.uncertainty.array.astype(
+                    np.float32
+                )
+
+        with open(filename, "wb") as f:
+            np.savez_compressed(f, **state)
+
+        return
+
+    @classmethod
+    def load_state(cls, filename, spectrum=None):
+        """Load a decomposition saved with save_state.
+
+        The precomputed matrix is loaded and interpolated anew, after
+        which all properties can be computed as usual.
+
+        Args:
+            filename (str): Path to load from.
+
+        Keywords:
+            spectrum (specutils.Spectrum): The decomposed spectrum,
+                required when it was not saved (defaults to the saved
+                spectrum).
+
+        Returns:
+            Decomposer: The decomposition.
+        """
+        from astropy.nddata import StdDevUncertainty
+        from specutils import Spectrum
+
+        with np.load(filename) as state:
+            if spectrum is None:
+                if "flux" not in state:
+                    raise ValueError(
+                        f"{filename}: spectrum was not saved and must be passed"
+                    )
+                uncertainty = None
+                if "uncertainty" in state:
+                    uncertainty = StdDevUncertainty(
+                        state["uncertainty"] * u.Unit(str(state["flux_unit"]))
+                    )
+                spectrum = Spectrum(
+                    flux=state["flux"] * u.Unit(str(state["flux_unit"])),
+                    spectral_axis=state["abscissa"]
+                    * u.Unit(str(state["abscissa_unit"])),
+                    uncertainty=uncertainty,
+                )
+                spectrum.meta["colnames"] = list(state["colnames"])
+
+            if spectral_fingerprint(spectrum.spectral_axis) != str(state["grid_hash"]):
+                raise ValueError(f"{filename}: spectral grid does not match")
+            if spectrum.flux.T.shape[1:] != tuple(state["weights_shape"][1:]):
+                raise ValueError(f"{filename}: spectrum shape does not match")
+
+            self = cls.__new__(cls)
+            self.spectrum = spectrum
+            self._mask = state["mask"]
+
+            dtype = np.dtype(str(state["dtype"])) if "dtype" in state else np.float64
+            self._weights = np.zeros(np.prod(state["weights_shape"]), dtype=dtype)
+            self._weights[state["weights_index"]] = state["weights_value"]
+            self._weights = np.reshape(self._weights, tuple(state["weights_shape"]))
+            self._timings = np.full(self._weights.shape[1:], np.nan)
+            self._chi2 = np.full(self._weights.shape[1:], np.nan)
+            self._weighted = bool(state["weighted"]) if "weighted" in state else False
+            self._variance = None
+            self._settings = {}
+            if "settings" in state:
+                self._settings = json.loads(str(state["settings"]))
+
+            version = str(state["version"])
+            matrix_hash = str(state["matrix_hash"])
+
+        # Reload and interpolate the precomputed matrix.
+        self._precomputed = _decomposer_load(version if version else None)
+        abscissa, _ = _decomposer_convert(spectrum)
+        self._matrix = _decomposer_matrix(self._precomputed, abscissa, dtype=dtype)
+
+        if (
+            hashlib.sha1(np.ascontiguousarray(self._matrix).tobytes()).hexdigest()
+            != matrix_hash
+        ):
+            raise ValueError(f"{filename}: precomputed matrix does not match")
+
+        return self
+
     def save_pdf(self, filename, header="", domaps=True, doplots=True):
         """Save a PDF summary of the fit results.
 
@@ -69,6 +239,10 @@ class Decomposer(DecomposerBase):
             None.
 
         """
+        # Import the plotting machinery only when needed.
+        import matplotlib.pyplot as plt
+        from astropy.wcs import WCS
+        from matplotlib.backends.backend_pdf import PdfPages
 
         with PdfPages(filename) as pdf:
             d = pdf.infodict()
@@ -337,6 +511,10 @@ class Decomposer(DecomposerBase):
             fig (matplotlib.figure.Figure): Instance of figure.
 
         """
+        # Import the plotting machinery only when needed.
+        import matplotlib.pyplot as plt
+        from matplotlib import cm, colormaps, colors
+        from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 
         mmin, mmax = np.nanpercentile(data[mask], (1, 99))
 
@@ -491,6 +669,9 @@ class Decomposer(DecomposerBase):
             fig (matplotlib.figure.Figure): Instance of figure.
 
         """
+        # Import the plotting machinery only when needed.
+        import matplotlib.gridspec as gridspec
+        import matplotlib.pyplot as plt
 
         # Create figure on shared axes.
         fig = plt.figure()
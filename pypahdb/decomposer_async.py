@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+decomposer_async.py
+
+asyncio entry points for fitting, computing properties and writing
+results without blocking the event loop.
+
+This file is part of pypahdb - see the module docs for more
+information.
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pypahdb.decomposer import Decomposer
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# pyplot is not thread-safe, hence PDFs are written one at a time.
+_pdf_lock = threading.Lock()
+
+
+def shared_executor():
+    """Return the shared executor, creating it on first use.
+
+    The executor's threads only coordinate; the actual fitting runs in
+    the shared multiprocessing pool of decomposer_base.
+
+    Returns:
+        concurrent.futures.ThreadPoolExecutor: The shared executor.
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(thread_name_prefix="pypahdb")
+
+        return _executor
+
+
+async def _run(executor, func, *args, **kwargs):
+    """Run func in executor, without blocking the event loop.
+
+    Cancelling the awaiting task cancels func when it has not started
+    yet; a running func completes in the background and its result is
+    discarded.
+    """
+    loop = asyncio.get_running_loop()
+    if executor is None:
+        executor = shared_executor()
+
+    return await loop.run_in_executor(executor, lambda: func(*args, **kwargs))
+
+
+async def decompose(spectrum, executor=None, **kwargs):
+    """Fit and decompose a spectrum.
+
+    Args:
+        spectrum (specutils.Spectrum): The data to fit/decompose.
+        executor (concurrent.futures.Executor): Optional, the executor
+            to use instead of the shared one.
+
+    Keywords:
+        kwargs: Passed on to Decomposer, e.g., version, cache, dtype or
+            weighted.
+
+    Returns:
+        Decomposer: The decomposition.
+    """
+    return await _run(executor, Decomposer, spectrum, **kwargs)
+
+
+async def compute(decomposer, *names, executor=None):
+    """Compute properties of a decomposition, e.g., 'fit' or 'charge'.
+
+    Args:
+        decomposer (Decomposer): The decomposition.
+        names (str): The names of the properties.
+        executor (concurrent.futures.Executor): Optional, the executor
+            to use instead of the shared one.
+
+    Returns:
+        dict: The value of each property.
+    """
+
+    def _compute():
+        return {name: getattr(decomposer, name) for name in names}
+
+    return await _run(executor, _compute)
+
+
+async def monte_carlo(decomposer, executor=None, **kwargs):
+    """Estimate uncertainties of a decomposition by resampling.
+
+    Args:
+        decomposer (Decomposer): The decomposition.
+        executor (concurrent.futures.Executor): Optional, the executor
+            to use instead of the shared one.
+
+    Keywords:
+        kwargs: Passed on to Decomposer.monte_carlo, e.g., n or
+            time_budget.
+
+    Returns:
+        dict: The percentile maps.
+    """
+    return await _run(executor, decomposer.monte_carlo, **kwargs)
+
+
+async def save_fits(decomposer, filename, header="", executor=None):
+    """Save FITS file summary of the fit results.
+
+    Args:
+        decomposer (Decomposer): The decomposition.
+        filename (str): Path to save to.
+        header (str): Optional, header for the FITS file.
+        executor (concurrent.futures.Executor): Optional, the executor
+            to use instead of the shared one.
+    """
+    await _run(executor, decomposer.save_fits, filename, header=header)
+
+
+async def save_pdf(
+    decomposer, filename, header="", domaps=True, doplots=True, executor=None
+):
+    """Save a PDF summary of the fit results.
+
+    Args:
+        decomposer (Decomposer): The decomposition.
+        filename (str): Path to save to.
+        header (str): Optional, header data.
+        domaps (bool): Save maps to PDF (defaults to True).
+        doplots (bool): Save plots to PDF (defaults to True).
+        executor (concurrent.futures.Executor): Optional, the executor
+            to use instead of the shared one.
+    """
+
+    def _save_pdf():
+        with _pdf_lock:
+            decomposer.save_pdf(filename, header=header, domaps=domaps, doplots=doplots)
+
+    await _run(executor, _save_pdf)
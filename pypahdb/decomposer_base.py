@@ -10,49 +10,116 @@ approach.
 This file is part of pypahdb - see the module docs for more
 information.
 """
+import atexit
+import hashlib
 import multiprocessing
+import os
 import pickle
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import warnings
+import weakref
+from collections import OrderedDict, namedtuple
 from functools import cached_property, partial
 
 import numpy as np
 from astropy import units as u
-from scipy.optimize import nnls
-from specutils import Spectrum
 
 from pypahdb.picker import Picker
 
 SMALL_SIZE = 50
 MEDIUM_SIZE = 70
 
+_pool = None
+_pool_processes = 1
+_pool_lock = threading.Lock()
+
+_budget = {"processes": None, "threads": None}
+
+# Quantities derived from the interpolated matrices, e.g., their QR
+# factorization, keyed by id and name and dropped along with their
+# matrix.
+_derived = {}
+_derived_lock = threading.Lock()
+
+# The directory holding the matrices shared with the pool processes,
+# and the shared matrices loaded by a pool process.
+_shared_dir = None
+_shared_lock = threading.Lock()
+_shared = OrderedDict()
+
+SOLVERS = ("nnls", "qr", "pg", "reduced")
+
+# Environment variables limiting the threads of the common BLAS and
+# OpenMP runtimes.
+_THREAD_VARIABLES = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+)
+
+
+def _decomposer_charges(charge):
+    """Return the selection of species of each charge state.
+
+    Args:
+        charge (numpy.ndarray): The charge of each species.
+
+    Returns:
+        dict: Boolean masks keyed by 'anion', 'neutral' and 'cation'.
+    """
+    return {"anion": charge < 0, "neutral": charge == 0, "cation": charge > 0}
+
+
+def _decomposer_sizes(size):
+    """Return the selection of species of each size class.
+
+    Args:
+        size (numpy.ndarray): The number of carbon atoms of each species.
+
+    Returns:
+        dict: Boolean masks keyed by 'large', 'medium' and 'small'.
+    """
+    return {
+        "large": size > MEDIUM_SIZE,
+        "medium": (size > SMALL_SIZE) & (size <= MEDIUM_SIZE),
+        "small": size <= SMALL_SIZE,
+    }
+
 
 def _decomposer_anion(w, m=None, p=None):
     """Do the anion decomposition in multiprocessing."""
-    return m.dot(w * (p < 0).astype(float))
+    return m.dot(w * _decomposer_charges(p)["anion"].astype(w.dtype))
 
 
 def _decomposer_neutral(w, m=None, p=None):
     """Do the neutral decomposition in multiprocessing."""
-    return m.dot(w * (p == 0).astype(float))
+    return m.dot(w * _decomposer_charges(p)["neutral"].astype(w.dtype))
 
 
 def _decomposer_cation(w, m=None, p=None):
     """Do the cation decomposition in multiprocessing."""
-    return m.dot(w * (p > 0).astype(float))
+    return m.dot(w * _decomposer_charges(p)["cation"].astype(w.dtype))
 
 
 def _decomposer_large(w, m=None, p=None):
     """Do the actual large decomposition in multiprocessing."""
-    return m.dot(w * (p > MEDIUM_SIZE).astype(float))
+    return m.dot(w * _decomposer_sizes(p)["large"].astype(w.dtype))
 
 
 def _decomposer_medium(w, m=None, p=None):
     """Do the actual large decomposition in multiprocessing."""
-    return m.dot(w * ((p > SMALL_SIZE) & (p <= MEDIUM_SIZE)).astype(float))
+    return m.dot(w * _decomposer_sizes(p)["medium"].astype(w.dtype))
 
 
 def _decomposer_small(w, m=None, p=None):
     """Do the small decomposition in multiprocessing."""
-    return m.dot(w * (p <= 50).astype(float))
+    return m.dot(w * _decomposer_sizes(p)["small"].astype(w.dtype))
 
 
 def _decomposer_fit(w, m=None):
@@ -61,16 +128,1223 @@ def _decomposer_fit(w, m=None):
     return m.dot(w)
 
 
-def _decomposer_interp(fp, x=None, xp=None):
+def _decomposer_interp(fp, x=None, xp=None, dtype=float):
     """Do the grid interpolation in multiprocessing."""
-    return np.interp(x, xp, fp)
+    return np.asarray(np.interp(x, xp, fp), dtype=dtype)
 
 
 def _decomposer_nnls(y, m=None):
-    """Do the NNLS in multiprocessing."""
+    """Do the NNLS in multiprocessing.
+
+    scipy's nnls works in float64, whatever the dtype of m and y.
+    """
+    from scipy.optimize import nnls
+
     return nnls(m, y)
 
 
+def _decomposer_polish(y, m=None, support=None):
+    """Do the NNLS restricted to a support in multiprocessing.
+
+    The species outside the support are checked for optimality and the
+    full NNLS is done when any of them would lower the residual.
+    """
+    x = np.zeros(m.shape[1])
+    if np.any(support):
+        x[support], rnorm = _decomposer_nnls(y, m=m[:, support])
+    else:
+        rnorm = np.linalg.norm(y)
+
+    gradient = m.T @ (m @ x - y)
+    if np.any(gradient[~support] < -1e-8 * np.linalg.norm(m.T @ y)):
+        return _decomposer_nnls(y, m=m)
+
+    return x, rnorm
+
+
+def _decomposer_reduced(y, m=None, basis=None):
+    """Do the NNLS with the representatives of the clusters of m in
+    multiprocessing.
+
+    Each selected representative is then either refitted with all
+    members of its cluster, restricted to the selected clusters, or its
+    weight is split evenly over the flux of the members.
+    """
+    labels, representatives, refit = basis
+    reduced, rnorm = _decomposer_nnls(y, m=m[:, representatives])
+    selected = np.flatnonzero(reduced > 0)
+    x = np.zeros(m.shape[1])
+    if not selected.size:
+        return x, rnorm
+
+    members = np.isin(labels, selected)
+    if refit:
+        x[members], rnorm = _decomposer_nnls(y, m=m[:, members])
+        return x, rnorm
+
+    norms = np.linalg.norm(m, axis=0)
+    counts = np.bincount(labels, minlength=len(representatives))
+    flux = reduced * norms[representatives] / counts
+    x[members] = np.divide(
+        flux[labels[members]],
+        norms[members],
+        out=np.zeros(np.count_nonzero(members)),
+        where=norms[members] > 0,
+    )
+
+    return x, np.linalg.norm(m @ x - y)
+
+
+def _decomposer_pg(a, y, tol=1e-6, max_iter=1000):
+    """Do the accelerated projected-gradient NNLS of many spectra at once.
+
+    All spectra are updated together with matrix-matrix products
+    against the Gram matrix aᵀa, using momentum that is restarted per
+    spectrum whenever it points uphill. A spectrum has converged once
+    the norm of its projected gradient is below tol relative to that
+    at zero weights; converged spectra are dropped from the iterations.
+
+    Args:
+        a (numpy.ndarray): The fitted matrix as (n_wave, n_species).
+        y (numpy.ndarray): The spectra as (n_wave, n_spectra).
+        tol (float): The relative tolerance (defaults to 1e-6).
+        max_iter (int): The maximum number of iterations (defaults to
+            1000).
+
+    Returns:
+        numpy.ndarray: The weights as (n_species, n_spectra).
+    """
+    gram = a.T @ a
+    b = a.T @ y
+    step = 1.0 / np.linalg.eigvalsh(gram)[-1]
+    norms = np.linalg.norm(b, axis=0)
+
+    weights = np.zeros(b.shape)
+    columns = np.arange(b.shape[1])
+    x = np.zeros(b.shape)
+    z = x.copy()
+    t = np.ones(b.shape[1])
+    for i in range(max_iter):
+        x_new = np.maximum(z - step * (gram @ z - b), 0.0)
+        restart = np.sum((z - x_new) * (x_new - x), axis=0) > 0
+        t_new = 0.5 * (1.0 + np.sqrt(1.0 + 4.0 * t**2))
+        momentum = np.where(restart, 0.0, (t - 1.0) / t_new)
+        t = np.where(restart, 1.0, t_new)
+        z = x_new + momentum * (x_new - x)
+        x = x_new
+
+        # Check for convergence every few iterations.
+        if i % 10 == 9:
+            gradient = gram @ x - b
+            gradient = np.where(x > 0, gradient, np.minimum(gradient, 0.0))
+            done = np.linalg.norm(gradient, axis=0) <= tol * norms
+            if np.any(done):
+                weights[:, columns[done]] = x[:, done]
+                keep = ~done
+                columns, x, z, t = columns[keep], x[:, keep], z[:, keep], t[keep]
+                b, norms = b[:, keep], norms[keep]
+                if not columns.size:
+                    break
+    weights[:, columns] = x
+
+    return weights
+
+
+def _decomposer_variance(a, x, rnorm, ratios, rows=None):
+    """Propagate the covariance of the passive-set weights to ratios of
+    linear combinations of the weights.
+
+    The covariance of the weights in the passive set P, those not held
+    at zero, follows from s² (A_Pᵀ A_P)⁻¹, with s² the residual
+    variance, and is propagated linearly to each ratio.
+
+    Args:
+        a (numpy.ndarray): The fitted matrix.
+        x (numpy.ndarray): The fitted weights.
+        rnorm (float): The norm of the residual.
+        ratios (tuple): The numerators, as (n_ratios, n_species), and
+            the denominator, as (n_species,).
+        rows (int): Optional, the number of channels fitted when a is
+            the triangular factor of the fitted matrix.
+
+    Returns:
+        numpy.ndarray: The variance of each ratio.
+    """
+    numerators, denominator = ratios
+    passive = x > 0
+    dof = (a.shape[0] if rows is None else rows) - np.count_nonzero(passive)
+    total = denominator @ x
+    if dof <= 0 or total <= 0:
+        return np.full(len(numerators), np.nan)
+
+    q = numerators @ x / total
+    jacobian = (numerators[:, passive] - q[:, None] * denominator[passive]) / total
+    z = jacobian @ np.linalg.pinv(a[:, passive])
+
+    return rnorm**2 / dof * np.sum(z**2, axis=1)
+
+
+def _decomposer_shared(path):
+    """Return a matrix shared by the parent, loading it once per pool
+    process."""
+    if path in _shared:
+        _shared.move_to_end(path)
+    else:
+        _shared[path] = np.load(path)
+        while len(_shared) > 4:
+            _shared.popitem(last=False)
+
+    return _shared[path]
+
+
+_BLOCK_FIELDS = [
+    "members",
+    "channels",
+    "ys",
+    "ws",
+    "scales",
+    "r",
+    "offsets",
+    "rows",
+    "support",
+    "elapsed",
+]
+
+
+class _Block(namedtuple("_Block", _BLOCK_FIELDS, defaults=6 * (None,) + (0.0,))):
+    """Spectra fitted together in a pool process, sharing their valid
+    channels and, when weighted, the profile of their weights.
+
+    Attributes:
+        members: The indices of the spectra among those fitted.
+        channels: The valid channels of the spectra, or None for all.
+        ys: The spectra as (n_valid, n_block).
+        ws: Optional, the weights, shared as (n_valid,) or per spectrum
+            as (n_valid, n_block).
+        scales: Optional, the scale split off the weights of each
+            spectrum.
+        r: Optional, the triangular factor R of the thin QR
+            factorization of the fitted matrix, with ys projected as Qᵀy.
+        offsets: Optional, the squared norm of the part of each spectrum
+            outside the range of Q.
+        rows: Optional, the number of channels fitted when projected.
+        support: Optional, the species to restrict the NNLS of each
+            spectrum to, as (n_species, n_block).
+        elapsed: The time already spent on each spectrum in seconds.
+    """
+
+    __slots__ = ()
+
+
+def _decomposer_nnls_block(block, m=None, ratios=None, basis=None):
+    """Do the timed NNLS of a block of spectra sharing their valid
+    channels in multiprocessing.
+
+    For weighted fits, the weights are either shared by the spectra in
+    the block, as (n_valid,), or given for each, as (n_valid, n_block),
+    with their per-spectrum scale split off to recover the chi-square.
+    With ratios, their variance is propagated from the fit.
+
+    A block may instead carry the triangular factor R of the thin QR
+    factorization of its fitted matrix, with the spectra projected as
+    Qᵀy and the squared norm of the part of each spectrum outside the
+    range of Q, so that each fit has only n_species rows. Or it may
+    carry the support of each spectrum, as (n_species, n_block), to
+    which the NNLS is restricted. With basis, the NNLS is done with
+    the representatives of the clusters of near-collinear species.
+
+    The matrix m is passed as the path of the file it is shared in.
+
+    Args:
+        block (_Block): The spectra to fit.
+
+    Keywords:
+        m (str): The path of the shared matrix, unless projected.
+        ratios (tuple): Optional, the ratios to propagate the fit
+            covariance to.
+        basis (tuple): Optional, the clusters of the 'reduced' solver.
+
+    Returns:
+        tuple: The members of the block and the weights, solve time,
+        chi-square, variance and residual norm of each spectrum.
+    """
+    if m is not None:
+        m = _decomposer_shared(m)
+    if block.r is not None:
+        m = block.r
+    if block.channels is not None:
+        m = m[block.channels]
+    ws = block.ws
+    ys = block.ys
+    if ws is not None and ws.ndim == 1:
+        m = m * ws[:, None]
+        ys = ys * ws[:, None]
+
+    results = []
+    for k, y in enumerate(ys.T):
+        t = time.perf_counter()
+        a = m
+        if ws is not None and ws.ndim == 2:
+            a = m * ws[:, k, None]
+            y = y * ws[:, k]
+        if block.support is None and basis is not None:
+            x, rnorm = _decomposer_reduced(y, m=a, basis=basis)
+        elif block.support is None:
+            x, rnorm = _decomposer_nnls(y, m=a)
+        else:
+            x, rnorm = _decomposer_polish(y, m=a, support=block.support[:, k])
+        if block.offsets is not None:
+            rnorm = np.sqrt(rnorm**2 + block.offsets[k])
+        dt = time.perf_counter() - t + block.elapsed
+        chi2 = np.nan if block.scales is None else (block.scales[k] * rnorm) ** 2
+        variance = None
+        if ratios is not None:
+            variance = _decomposer_variance(a, x, rnorm, ratios, rows=block.rows)
+        results.append((x, dt, chi2, variance, rnorm))
+
+    return block.members, results
+
+
+def _decomposer_initializer(threads):
+    """Limit the BLAS/OpenMP threads of a pool process."""
+    # Runtimes loaded after this point, e.g., by scipy.optimize, read
+    # the environment; threadpoolctl also limits those already loaded.
+    for name in _THREAD_VARIABLES:
+        os.environ[name] = str(threads)
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+
+    threadpool_limits(limits=threads)
+
+
+def _cpu_count():
+    """Return the number of CPUs available to this process."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def _budget_env(name):
+    """Return the positive integer in environment variable name, or None
+    when it is unset or empty."""
+    value = os.getenv(name, "").strip()
+    if not value:
+        return None
+
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ValueError(f"{name} must be a positive integer, not {value!r}")
+
+    return number
+
+
+def thread_budget():
+    """Return the number of pool processes and of BLAS threads each.
+
+    Unless set with set_thread_budget, the processes default to
+    PYPAHDB_PROCESSES or one less than the available CPUs, and the
+    threads to PYPAHDB_BLAS_THREADS or the available CPUs divided over
+    the processes. Empty variables count as unset.
+
+    Returns:
+        tuple: The number of processes and of threads per process.
+
+    Raises:
+        ValueError: When a variable is not a positive integer.
+    """
+    cpus = _cpu_count()
+    processes = _budget["processes"] or _budget_env("PYPAHDB_PROCESSES")
+    if not processes:
+        processes = max(1, cpus - 1)
+    threads = _budget["threads"] or _budget_env("PYPAHDB_BLAS_THREADS")
+    if not threads:
+        threads = max(1, cpus // processes)
+
+    return processes, threads
+
+
+def set_thread_budget(processes=None, threads=None):
+    """Set the number of pool processes and of BLAS threads each.
+
+    The shared pool is closed, after finishing its pending work, when
+    the budget changes and recreated on next use. None restores the
+    default of thread_budget.
+
+    Keywords:
+        processes (int): The number of pool processes.
+        threads (int): The number of BLAS/OpenMP threads per process.
+    """
+    global _pool
+
+    for value in (processes, threads):
+        if value is not None and value < 1:
+            raise ValueError("processes and threads must be at least 1")
+
+    with _pool_lock:
+        current = thread_budget()
+        _budget["processes"] = processes
+        _budget["threads"] = threads
+        if _pool is not None and thread_budget() != current:
+            _pool.close()
+            _pool.join()
+            atexit.unregister(_pool.terminate)
+            _pool = None
+
+
+def _decomposer_pool():
+    """Return the shared multiprocessing pool, creating it on first use."""
+    global _pool, _pool_processes
+
+    with _pool_lock:
+        if _pool is None:
+            _pool_processes, threads = thread_budget()
+
+            # Processes started by spawn or forkserver pick up the limits
+            # from the environment when loading their BLAS.
+            saved = {name: os.environ.get(name) for name in _THREAD_VARIABLES}
+            os.environ.update({name: str(threads) for name in _THREAD_VARIABLES})
+            try:
+                _pool = multiprocessing.Pool(
+                    processes=_pool_processes,
+                    initializer=_decomposer_initializer,
+                    initargs=(threads,),
+                )
+            finally:
+                for name, value in saved.items():
+                    if value is None:
+                        os.environ.pop(name, None)
+                    else:
+                        os.environ[name] = value
+            atexit.register(_pool.terminate)
+
+        return _pool
+
+
+def _decomposer_derived(matrix, name, func):
+    """Return a quantity derived from the interpolated matrix, cached for
+    as long as the matrix itself lives.
+
+    Args:
+        matrix (numpy.ndarray): The interpolated matrix.
+        name: The name of the quantity, including its parameters.
+        func (callable): Computes the quantity.
+
+    Returns:
+        The quantity.
+    """
+    key = (id(matrix), name)
+    with _derived_lock:
+        entry = _derived.get(key)
+        if entry is not None and entry[0]() is matrix:
+            return entry[1]
+
+    value = func()
+    with _derived_lock:
+        _derived[key] = (weakref.ref(matrix), value)
+        weakref.finalize(matrix, _derived.pop, key, None)
+
+    return value
+
+
+def _decomposer_unshare(path):
+    """Remove the file of a shared matrix, when still there."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _decomposer_share(matrix, m):
+    """Share the normalized matrix m with the pool processes.
+
+    The matrix is written to a file once, for as long as the interpolated
+    matrix lives, so that each task only carries its path and each pool
+    process loads it only once.
+
+    Args:
+        matrix (numpy.ndarray): The interpolated matrix.
+        m (numpy.ndarray): The normalized matrix.
+
+    Returns:
+        str: The path of the file.
+    """
+
+    def _write():
+        global _shared_dir
+
+        with _shared_lock:
+            if _shared_dir is None:
+                _shared_dir = tempfile.mkdtemp(prefix="pypahdb-")
+                atexit.register(shutil.rmtree, _shared_dir, True)
+        path = os.path.join(_shared_dir, f"{uuid.uuid4().hex}.npy")
+        np.save(path, m)
+        weakref.finalize(matrix, _decomposer_unshare, path)
+
+        return path
+
+    return _decomposer_derived(matrix, "shared", _write)
+
+
+def _decomposer_qr(matrix, m):
+    """Return the thin QR factorization of the normalized matrix m.
+
+    Args:
+        matrix (numpy.ndarray): The interpolated matrix.
+        m (numpy.ndarray): The normalized matrix.
+
+    Returns:
+        tuple: Q, as (n_wave, n_species), and R, as (n_species,
+        n_species), in float64.
+    """
+    return _decomposer_derived(
+        matrix, "qr", lambda: np.linalg.qr(np.asarray(m, dtype=np.float64))
+    )
+
+
+def _decomposer_basis(matrix, m, similarity=0.999):
+    """Return the clusters of near-collinear columns of the normalized
+    matrix m.
+
+    Going from the brightest column down, each column not yet clustered
+    becomes the representative of a new cluster, which takes all other
+    columns not yet clustered whose cosine similarity with it is at
+    least similarity.
+
+    Args:
+        matrix (numpy.ndarray): The interpolated matrix.
+        m (numpy.ndarray): The normalized matrix.
+        similarity (float): The minimum cosine similarity with the
+            representative (defaults to 0.999).
+
+    Returns:
+        tuple: The cluster of each column, as (n_species,), and the
+        column of each representative, as (n_clusters,).
+    """
+
+    def _cluster():
+        norms = np.linalg.norm(np.asarray(m, dtype=np.float64), axis=0)
+        units = np.divide(m, norms, out=np.zeros(m.shape), where=norms > 0)
+        labels = np.full(m.shape[1], -1)
+        representatives = []
+        for i in np.argsort(-norms, kind="stable"):
+            if labels[i] >= 0:
+                continue
+            members = (labels < 0) & (units.T @ units[:, i] >= similarity)
+            members[i] = True
+            labels[members] = len(representatives)
+            representatives.append(i)
+
+        return labels, np.array(representatives)
+
+    return _decomposer_derived(matrix, ("basis", similarity), _cluster)
+
+
+def _decomposer_settings(solver="nnls", solver_options=None):
+    """Return the solver settings passed on to _decomposer_solve.
+
+    The defaults are left out, keeping the keys of the result cache.
+
+    Args:
+        solver (str): The solver.
+        solver_options (dict): Optional, the options of the solver.
+
+    Returns:
+        dict: The settings.
+    """
+    if solver not in SOLVERS:
+        raise ValueError(f"unknown solver {solver!r}")
+
+    settings = dict(solver_options or {})
+    if solver != "nnls":
+        settings["solver"] = solver
+
+    return settings
+
+
+def spectral_fingerprint(spectral_axis, flux_unit=None):
+    """Return a fingerprint identifying a spectral grid.
+
+    Args:
+        spectral_axis (quantity.Quantity): The spectral axis.
+        flux_unit (astropy.units.Unit): Optional, the flux unit.
+
+    Returns:
+        str: Hexadecimal digest of the grid values and units.
+    """
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(spectral_axis.value, dtype=float).tobytes())
+    digest.update(str(spectral_axis.unit).encode())
+    if flux_unit is not None:
+        digest.update(str(flux_unit).encode())
+
+    return digest.hexdigest()
+
+
+def _decomposer_convert(spectrum):
+    """Convert a spectrum to wavenumber and flux (density).
+
+    Args:
+        spectrum (specutils.Spectrum): The spectrum to convert.
+
+    Returns:
+        tuple: The abscissa and the transposed ordinate.
+    """
+    abscissa = spectrum.spectral_axis.to(1.0 / u.cm, equivalencies=u.spectral())
+    try:
+        ordinate = spectrum.flux.to(u.Unit("MJy/sr"), equivalencies=u.spectral()).T
+    except u.UnitConversionError:
+        ordinate = spectrum.flux.to(u.Unit("Jy"), equivalencies=u.spectral()).T
+
+    return abscissa, ordinate
+
+
+def _decomposer_sigma(spectrum, unit):
+    """Return the transposed standard deviation of a spectrum in unit.
+
+    Args:
+        spectrum (specutils.Spectrum): The spectrum.
+        unit (astropy.units.Unit): The unit of the converted flux.
+
+    Returns:
+        quantity.Quantity: The standard deviation.
+    """
+    from astropy.nddata import StdDevUncertainty
+
+    if spectrum.uncertainty is None:
+        raise ValueError("spectrum has no uncertainty")
+
+    uncertainty = spectrum.uncertainty.represent_as(StdDevUncertainty)
+    sigma = uncertainty.array * (uncertainty.unit or spectrum.flux.unit)
+
+    return sigma.to(unit, equivalencies=u.spectral()).T
+
+
+def _decomposer_ratios(precomputed):
+    """Return the charge and size fractions and the average number of
+    carbon atoms as ratios of linear combinations of the weights.
+
+    Args:
+        precomputed (dict): The precomputed matrix.
+
+    Returns:
+        tuple: The (property, key) of each ratio and the ratios as
+        numerators and denominator.
+    """
+    charge = precomputed["properties"]["charge"]
+    size = precomputed["properties"]["size"]
+    numerators = {}
+    for key, select in _decomposer_charges(charge).items():
+        numerators[("charge_fractions", key)] = select
+    for key, select in _decomposer_sizes(size).items():
+        numerators[("size_fractions", key)] = select
+    numerators[("nc", None)] = size
+
+    return list(numerators), (
+        np.array(list(numerators.values()), dtype=float),
+        np.ones(len(charge)),
+    )
+
+
+def _decomposer_load(version=None):
+    """Pick and load the precomputed matrix.
+
+    Args:
+        version (str): The version of the precomputed matrix to use.
+
+    Returns:
+        dict: The precomputed matrix.
+    """
+    return precomputed_cache.get(Picker().pick(version))
+
+
+def _decomposer_matrix(precomputed, abscissa, dtype=np.float64):
+    """Interpolate the precomputed spectra onto a frequency grid.
+
+    Args:
+        precomputed (dict): The precomputed matrix.
+        abscissa (quantity.Quantity): The frequency grid in wavenumber.
+        dtype (numpy.dtype): The dtype of the interpolated matrix.
+
+    Returns:
+        numpy.ndarray: The interpolated matrix.
+    """
+    decomposer_interp = partial(
+        _decomposer_interp,
+        x=abscissa,
+        xp=precomputed["abscissa"] / u.cm,
+        dtype=dtype,
+    )
+
+    matrix = _decomposer_pool().map(decomposer_interp, precomputed["matrix"].T)
+
+    return np.array(matrix, dtype=dtype).T
+
+
+def _decomposer_mask(pool_shape):
+    """Return the spectra worth fitting, i.e., those with a positive sum
+    over their valid, finite, channels.
+
+    Args:
+        pool_shape (numpy.ndarray): The spectra as (n_wave, n_spectra).
+
+    Returns:
+        numpy.ndarray: The spectra to fit.
+    """
+    pool_shape = np.asarray(pool_shape)
+
+    return np.sum(pool_shape, axis=0, where=np.isfinite(pool_shape)) > 0.0
+
+
+def _decomposer_take(block, k):
+    """Return the spectra k of a block.
+
+    Args:
+        block (_Block): The block.
+        k: The indices, or slice, of the spectra in the block.
+
+    Returns:
+        _Block: The block of the selected spectra.
+    """
+    ws = block.ws
+    if ws is not None and ws.ndim == 2:
+        ws = ws[:, k]
+
+    return block._replace(
+        members=block.members[k],
+        ys=block.ys[:, k],
+        ws=ws,
+        scales=None if block.scales is None else block.scales[k],
+        offsets=None if block.offsets is None else block.offsets[k],
+        support=None if block.support is None else block.support[:, k],
+    )
+
+
+def _decomposer_chunks(block, chunksize):
+    """Split a block into chunks of at most chunksize spectra."""
+    return [
+        _decomposer_take(block, slice(start, start + chunksize))
+        for start in range(0, len(block.members), chunksize)
+    ]
+
+
+def _decomposer_blocks(pool_shape, index, valid, sigma=None, b_scl=None):
+    """Group the spectra to fit by the matrix they are fitted with.
+
+    Spectra are grouped by their valid channels and, when weighted, by
+    the profile of their weights, up to a scale. Weighted spectra not
+    sharing their profile with any other are put in a block weighted
+    per spectrum.
+
+    Args:
+        pool_shape (numpy.ndarray): The normalized spectra as (n_wave,
+            n_spectra).
+        index (numpy.ndarray): The spectra to fit.
+        valid (numpy.ndarray): The valid channels of each spectrum.
+        sigma (numpy.ndarray): Optional, the standard deviation of the
+            spectra, for a weighted fit.
+        b_scl (numpy.ndarray): The normalization of the spectra,
+            required with sigma.
+
+    Returns:
+        list: A _Block for each group, with members indexing index.
+    """
+    # Group the spectra by their valid channels.
+    if np.all(valid[:, index]):
+        groups = [(None, np.arange(len(index)))]
+    else:
+        patterns, inverse = np.unique(
+            np.packbits(valid[:, index], axis=0).T, axis=0, return_inverse=True
+        )
+        inverse = inverse.ravel()
+        groups = []
+        for g in range(len(patterns)):
+            members = np.flatnonzero(inverse == g)
+            channels = valid[:, index[members[0]]]
+            groups.append((None if np.all(channels) else channels, members))
+
+    blocks = []
+    for channels, members in groups:
+        ys = pool_shape[:, index[members]]
+        if channels is not None:
+            ys = ys[channels]
+
+        if sigma is None:
+            blocks.append(_Block(members, channels, ys))
+            continue
+
+        # Split the weights into a profile and a scale, and group the
+        # spectra by their profile, ignoring round-off.
+        ws = b_scl[index[members]].astype(np.float64) / sigma[:, index[members]]
+        if channels is not None:
+            ws = ws[channels]
+        scales = np.max(ws, axis=0)
+        ws = np.round(ws / scales, 12)
+        profiles, inverse = np.unique(ws.T, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        counts = np.bincount(inverse)
+        for p in np.flatnonzero(counts > 1):
+            shared = np.flatnonzero(inverse == p)
+            blocks.append(
+                _Block(
+                    members[shared], channels, ys[:, shared], profiles[p], scales[shared]
+                )
+            )
+        single = np.flatnonzero(counts[inverse] == 1)
+        if single.size:
+            blocks.append(
+                _Block(
+                    members[single], channels, ys[:, single], ws[:, single], scales[single]
+                )
+            )
+
+    return blocks
+
+
+def _decomposer_system(block, m):
+    """Return the fitted matrix and the spectra of a block sharing its
+    weights, weighted and in float64."""
+    a = m if block.channels is None else m[block.channels]
+    y = np.asarray(block.ys, dtype=np.float64)
+    if block.ws is not None:
+        a = a * block.ws[:, None]
+        y = y * block.ws[:, None]
+
+    return np.asarray(a, dtype=np.float64), y
+
+
+def _decomposer_emit_nnls(block, matrix, m, chunksize, **options):
+    """Emit the NNLS of the spectra in a block, in chunks.
+
+    Args:
+        block (_Block): The spectra to fit.
+        matrix (numpy.ndarray): The interpolated matrix.
+        m (numpy.ndarray): The normalized matrix.
+        chunksize (int): The maximum number of spectra in a chunk.
+
+    Keywords:
+        options: The ratios and the options of the solver.
+
+    Returns:
+        tuple: The chunks to fit in the pool, the projected blocks to
+        check as (fitted matrix, spectra, block), and the results of
+        spectra already fitted as (members, results).
+    """
+    return _decomposer_chunks(block, chunksize), [], []
+
+
+def _decomposer_emit_qr(block, matrix, m, chunksize, **options):
+    """Emit the NNLS of the spectra in a block projected onto Q of the
+    thin QR factorization of their fitted matrix, see
+    _decomposer_emit_nnls.
+
+    Spectra weighted individually, or with fewer channels than species,
+    are fitted with the full matrix.
+    """
+    if (block.ws is not None and block.ws.ndim == 2) or len(block.ys) <= m.shape[1]:
+        return _decomposer_emit_nnls(block, matrix, m, chunksize)
+
+    a, y = _decomposer_system(block, m)
+    if block.channels is None and block.ws is None:
+        q, r = _decomposer_qr(matrix, m)
+    else:
+        q, r = np.linalg.qr(a)
+    z = q.T @ y
+    offsets = np.sum((y - q @ z) ** 2, axis=0)
+    projected = _Block(
+        block.members, None, z, scales=block.scales, r=r, offsets=offsets, rows=len(a)
+    )
+
+    return _decomposer_chunks(projected, chunksize), [(a, y, block)], []
+
+
+def _decomposer_emit_pg(
+    block, matrix, m, chunksize, ratios=None, tol=1e-6, max_iter=1000, polish=True
+):
+    """Fit the spectra in a block at once by projected gradient and
+    emit their polishing NNLS, restricted to the selected species, see
+    _decomposer_emit_nnls.
+
+    Spectra weighted individually are fitted with NNLS.
+    """
+    if block.ws is not None and block.ws.ndim == 2:
+        return _decomposer_emit_nnls(block, matrix, m, chunksize)
+
+    a, y = _decomposer_system(block, m)
+    t = time.perf_counter()
+    x = _decomposer_pg(a, y, tol=tol, max_iter=max_iter)
+    elapsed = (time.perf_counter() - t) / len(block.members)
+    if polish:
+        block = block._replace(support=x > 0, elapsed=elapsed)
+        return _decomposer_chunks(block, chunksize), [], []
+
+    rnorm = np.linalg.norm(a @ x - y, axis=0)
+    results = []
+    for k in range(len(block.members)):
+        variance = None
+        if ratios is not None:
+            variance = _decomposer_variance(a, x[:, k], rnorm[k], ratios)
+        chi2 = np.nan if block.scales is None else (block.scales[k] * rnorm[k]) ** 2
+        results.append((x[:, k], elapsed, chi2, variance, rnorm[k]))
+
+    return [], [], [(block.members, results)]
+
+
+# The emitter of each solver; 'reduced' differs from 'nnls' only in the
+# pool processes.
+_EMITTERS = {
+    "nnls": _decomposer_emit_nnls,
+    "qr": _decomposer_emit_qr,
+    "pg": _decomposer_emit_pg,
+    "reduced": _decomposer_emit_nnls,
+}
+
+
+def _decomposer_collect(
+    members, results, index, fitted, rnorms, timings=None, chi2=None, variance=None
+):
+    """Store the results of fitted spectra.
+
+    Args:
+        members (numpy.ndarray): The indices of the spectra in index.
+        results (list): The weights, solve time, chi-square, variance
+            and residual norm of each spectrum.
+        index (numpy.ndarray): The fitted spectra.
+        fitted (numpy.ndarray): Receives the weights.
+        rnorms (numpy.ndarray): Receives the residual norms.
+        timings, chi2, variance: As for _decomposer_solve.
+    """
+    for i, (x, dt, c2, var, rnorm) in zip(members, results):
+        fitted[i] = x
+        rnorms[i] = rnorm
+        if timings is not None:
+            timings[index[i]] = dt
+        if chi2 is not None:
+            chi2[index[i]] = c2
+        if variance is not None and var is not None:
+            variance[index[i]] = var
+
+
+def _decomposer_solve(
+    matrix,
+    pool_shape,
+    mask,
+    timings=None,
+    chi2=None,
+    sigma=None,
+    ratios=None,
+    variance=None,
+    solver="nnls",
+    tol=1e-6,
+    max_iter=1000,
+    polish=True,
+    similarity=0.999,
+    refit=True,
+):
+    """Fit the unmasked spectra using NNLS.
+
+    The spectra are handed out in small chunks and collected as they
+    complete, so workers that drew quickly converging spectra pick up
+    more instead of idling while others work through the slow ones.
+
+    Non-finite channels, e.g., NaNs, are left out of the fit of their
+    spectrum. Spectra sharing the same valid channels are chunked
+    together, so each chunk reduces the matrix only once.
+
+    With sigma, each channel is weighted by its inverse standard
+    deviation. Spectra whose weights have the same profile, up to a
+    scale, share one weighted matrix per chunk; the others have the rows
+    of the matrix scaled for each spectrum.
+
+    The spectra are not kept at a higher precision than the matrix, and
+    the weights are returned in the dtype of the matrix, while the NNLS
+    itself and the rescaling of the weights are done in float64.
+
+    With the 'qr' solver, the fitted matrix of each chunk is replaced by
+    R of its thin QR factorization, M = QR, and the spectra by Qᵀy, as
+    ||Mw - y||² = ||Rw - Qᵀy||² + ||y - QQᵀy||². Each fit then has only
+    n_species rows, while the projection is done for all spectra with a
+    single matrix product. The residual recovered for each spectrum is
+    checked against that of the full problem and spectra failing the
+    check are refitted with the full matrix. Spectra that are weighted
+    individually, or with fewer channels than species, are always
+    fitted with the full matrix.
+
+    With the approximate 'pg' solver, spectra sharing their fitted matrix
+    are fitted all at once by accelerated projected gradient, see
+    _decomposer_pg, up to tol or max_iter. With polish, the NNLS of each
+    spectrum is then redone exactly, restricted to the species selected
+    by the projected gradient. Spectra that are weighted individually
+    are always fitted with NNLS.
+
+    With the approximate 'reduced' solver, the species are clustered by
+    the cosine similarity of their interpolated spectra, see
+    _decomposer_basis, and each spectrum is fitted with the
+    representatives of the clusters only. With refit, the spectrum is
+    then refitted with all species in the selected clusters; otherwise
+    the weight of each representative is split evenly over the flux of
+    the species in its cluster. Either way, the weights remain those of
+    individual species, so their charge and size carry over.
+
+    Args:
+        matrix (numpy.ndarray): The interpolated matrix.
+        pool_shape (numpy.ndarray): The spectra as (n_wave, n_spectra).
+        mask (numpy.ndarray): The spectra to fit.
+        timings (numpy.ndarray): Optional, receives the solve time of
+            each fitted spectrum in seconds.
+        chi2 (numpy.ndarray): Optional, receives the chi-square of each
+            fitted spectrum when weighted.
+        sigma (numpy.ndarray): Optional, the standard deviation of the
+            spectra as (n_wave, n_spectra), for a weighted fit.
+        ratios (tuple): Optional, the numerators, as (n_ratios,
+            n_species), and the denominator, as (n_species,), of ratios
+            of the weights to propagate the fit covariance to.
+        variance (numpy.ndarray): Optional, receives the variance of the
+            ratios of each fitted spectrum as (n_spectra, n_ratios).
+        solver (str): The solver, either 'nnls', 'qr', 'pg' or 'reduced'
+            (defaults to 'nnls').
+        tol (float): The relative tolerance of the 'pg' solver (defaults
+            to 1e-6).
+        max_iter (int): The maximum number of iterations of the 'pg'
+            solver (defaults to 1000).
+        polish (bool): Redo the NNLS of the 'pg' solver exactly on the
+            selected species (defaults to True).
+        similarity (float): The minimum cosine similarity of the species
+            in a cluster of the 'reduced' solver (defaults to 0.999).
+        refit (bool): Refit with all species in the clusters selected by
+            the 'reduced' solver (defaults to True).
+
+    Returns:
+        numpy.ndarray: The weights as (n_spectra, n_species).
+    """
+    if solver not in SOLVERS:
+        raise ValueError(f"unknown solver {solver!r}")
+
+    # Copy and normalize the matrix.
+    m = matrix.copy()
+    m_scl = m.max()
+    m /= m_scl
+
+    # Normalize spectral input.
+    pool_shape = np.array(pool_shape)
+    if pool_shape.dtype.itemsize > matrix.dtype.itemsize:
+        pool_shape = pool_shape.astype(matrix.dtype)
+    valid = np.isfinite(pool_shape)
+    if sigma is not None:
+        sigma = np.asarray(sigma, dtype=np.float64)
+        valid &= np.isfinite(sigma) & (sigma > 0)
+        mask = mask & np.any(valid, axis=0)
+    b_scl = np.max(pool_shape, axis=0, where=valid, initial=-np.inf)
+    np.divide(pool_shape, b_scl[None, :], out=pool_shape, where=mask)
+
+    # Perform the fit.
+    weights = np.zeros((pool_shape.shape[1], matrix.shape[1]), dtype=matrix.dtype)
+    if np.any(mask):
+        pool = _decomposer_pool()
+        index = np.flatnonzero(mask)
+        fitted = np.zeros((len(index), matrix.shape[1]))
+        rnorms = np.zeros(len(index))
+        outputs = dict(
+            index=index,
+            fitted=fitted,
+            rnorms=rnorms,
+            timings=timings,
+            chi2=chi2,
+            variance=variance,
+        )
+
+        # Chunks carry the spectra but not the matrix, which each
+        # worker loads only once; aim for sixteen chunks per worker.
+        chunksize = max(1, -(-len(index) // (16 * _pool_processes)))
+
+        chunks = []
+        projected = []
+        for block in _decomposer_blocks(pool_shape, index, valid, sigma, b_scl):
+            emitted, checks, done = _EMITTERS[solver](
+                block,
+                matrix,
+                m,
+                chunksize,
+                ratios=ratios,
+                tol=tol,
+                max_iter=max_iter,
+                polish=polish,
+            )
+            chunks += emitted
+            projected += checks
+            for members, results in done:
+                _decomposer_collect(members, results, **outputs)
+
+        basis = None
+        if solver == "reduced":
+            basis = _decomposer_basis(matrix, m, similarity) + (refit,)
+
+        while chunks:
+            # The matrix is only needed by chunks not projected onto Q.
+            decomposer_nnls = partial(
+                _decomposer_nnls_block,
+                m=_decomposer_share(matrix, m) if any(c.r is None for c in chunks) else None,
+                ratios=ratios,
+                basis=basis,
+            )
+            for members, results in pool.imap_unordered(decomposer_nnls, chunks):
+                _decomposer_collect(members, results, **outputs)
+
+            # Check the recovered residuals against the full problem and
+            # refit the spectra failing the check with the full matrix.
+            chunks = []
+            for a, y, block in projected:
+                full = np.linalg.norm(a @ fitted[block.members].T - y, axis=0)
+                tolerance = 1e-8 * np.linalg.norm(y, axis=0)
+                failed = np.flatnonzero(np.abs(full - rnorms[block.members]) > tolerance)
+                if failed.size:
+                    chunks += _decomposer_chunks(_decomposer_take(block, failed), chunksize)
+            projected = []
+
+        # Scale weights back.
+        weights[mask] = fitted / (
+            np.float64(m_scl) / b_scl[mask, None].astype(np.float64)
+        )
+
+    return weights
+
+
+def _decomposer_weights(
+    matrix,
+    pool_shape,
+    mask,
+    abscissa,
+    unit,
+    settings,
+    cache=None,
+    timings=None,
+    chi2=None,
+    sigma=None,
+    ratios=None,
+    variance=None,
+):
+    """Fit the unmasked spectra, reusing the weights in cache when given.
+
+    Args:
+        matrix (numpy.ndarray): The interpolated matrix.
+        pool_shape (numpy.ndarray): The spectra as (n_wave, n_spectra).
+        mask (numpy.ndarray): The spectra to fit.
+        abscissa (quantity.Quantity): The frequency grid.
+        unit (astropy.units.Unit): The flux unit.
+        settings (dict): The solver settings.
+
+    Keywords:
+        cache (ResultCache): Optional, the cache of fitted weights.
+        timings, chi2, sigma, ratios, variance: As for _decomposer_solve.
+
+    Returns:
+        numpy.ndarray: The weights as (n_spectra, n_species).
+    """
+    outputs = dict(
+        timings=timings, chi2=chi2, sigma=sigma, ratios=ratios, variance=variance
+    )
+    if cache is None:
+        return _decomposer_solve(matrix, pool_shape, mask, **outputs, **settings)
+
+    return cache.solve(matrix, pool_shape, mask, abscissa, unit, **outputs, **settings)
+
+
+class PrecomputedCache(object):
+    """Thread-safe least-recently-used cache of loaded precomputed
+    matrices.
+
+    Entries are keyed by path, modification time and size of the pickle,
+    so a replaced pickle is reloaded. The loaded matrices are shared and
+    must not be modified.
+
+    Attributes:
+        maxcount (int): Maximum number of cached matrices.
+        maxbytes (int): Maximum total size of the cached pickles in bytes,
+            None for no limit. The most recently used matrix is always
+            kept.
+    """
+
+    def __init__(self, maxcount=2, maxbytes=None):
+        """Construct a cache object.
+
+        Keywords:
+            maxcount (int): Maximum number of cached matrices (defaults
+                to 2).
+            maxbytes (int): Maximum total size of the cached pickles in
+                bytes (defaults to None).
+        """
+        self.maxcount = maxcount
+        self.maxbytes = maxbytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Return the precomputed matrix at path, loading it when needed.
+
+        Args:
+            path (pathlib.Path): The path to the pickle.
+
+        Returns:
+            dict: The precomputed matrix.
+        """
+        st = os.stat(path)
+        key = (str(path), st.st_mtime_ns, st.st_size)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+            with open(path, "rb") as f:
+                precomputed = pickle.load(f, encoding="latin1")
+
+            # Drop stale entries of the same file.
+            for k in [k for k in self._entries if k[0] == key[0]]:
+                del self._entries[k]
+
+            self._entries[key] = precomputed
+            self._evict()
+
+            return precomputed
+
+    def resize(self, maxcount=None, maxbytes=None):
+        """Change the limits of the cache.
+
+        Keywords:
+            maxcount (int): Maximum number of cached matrices.
+            maxbytes (int): Maximum total size of the cached pickles in
+                bytes.
+        """
+        with self._lock:
+            if maxcount is not None:
+                self.maxcount = maxcount
+            self.maxbytes = maxbytes
+            self._evict()
+
+    def clear(self):
+        """Empty the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self):
+        """Drop the least-recently-used entries exceeding the limits."""
+        while len(self._entries) > max(self.maxcount, 0) or (
+            self.maxbytes is not None
+            and len(self._entries) > 1
+            and sum(k[2] for k in self._entries) > self.maxbytes
+        ):
+            self._entries.popitem(last=False)
+
+
+precomputed_cache = PrecomputedCache()
+
+
 class DecomposerBase(object):
     """Fit and decompose spectrum.
 
@@ -78,14 +1352,45 @@ class DecomposerBase(object):
        spectrum: A spectrum to fit and decompose.
     """
 
-    def __init__(self, spectrum, version=None):
+    def __init__(
+        self,
+        spectrum,
+        version=None,
+        cache=None,
+        dtype=np.float64,
+        weighted=False,
+        uncertainties=False,
+        solver="nnls",
+        solver_options=None,
+    ):
         """Construct a decomposer object.
 
         Args:
             spectrum (specutil.Spectrum): The spectrum to fit and decompose.
             version (str): The version of the precomputed matrix to use.
+            cache (ResultCache): Optional, cache of fitted weights.
+            dtype (numpy.dtype): The dtype of the interpolated matrix, the
+                weights and the spectral breakdowns, e.g., numpy.float32
+                to halve their memory use (defaults to numpy.float64).
+            weighted (bool): Weight the fit by the uncertainty of the
+                spectrum (defaults to False).
+            uncertainties (bool): Propagate the covariance of the fit to
+                the uncertainties of the charge and size fractions and
+                the average number of carbon atoms (defaults to False).
+            solver (str): The solver, either 'nnls', 'qr', which fits
+                the spectra projected onto the QR factorization of the
+                interpolated matrix and is faster for long spectral
+                grids, the approximate 'pg', which fits the spectra all
+                at once by projected gradient, or the approximate
+                'reduced', which fits with representatives of clusters
+                of near-collinear species (defaults to 'nnls').
+            solver_options (dict): Optional, the options of the solver,
+                i.e., tol, max_iter and polish for 'pg' and similarity
+                and refit for 'reduced'.
         """
 
+        from specutils import Spectrum
+
         # Check if spectrum is a Spectrum
         if not isinstance(spectrum, Spectrum):
             print("spectrum is not a specutils.Spectrum")
@@ -94,74 +1399,164 @@ class DecomposerBase(object):
         self.spectrum = spectrum
 
         # Convert units of spectrum to wavenumber and flux (density).
-        abscissa = self.spectrum.spectral_axis.to(
-            1.0 / u.cm, equivalencies=u.spectral()
-        )
-        try:
-            ordinate = self.spectrum.flux.to(
-                u.Unit("MJy/sr"), equivalencies=u.spectral()
-            ).T
-        except u.UnitConversionError:
-            ordinate = self.spectrum.flux.to(u.Unit("Jy"), equivalencies=u.spectral()).T
-            pass
+        abscissa, ordinate = _decomposer_convert(self.spectrum)
 
         # For clarity, define a few quantities.
         n_elements_yz = ordinate.shape[1] * ordinate.shape[2]
         pool_shape = np.reshape(ordinate, (ordinate.shape[0], n_elements_yz))
 
         # Avoid fitting -zero- spectra.
-        self._mask = np.sum(pool_shape, axis=0) > 0.0
+        self._mask = _decomposer_mask(pool_shape)
         if np.all(self._mask is False):
             print("spectral data is all zeros.")
             return None
 
+        # Use the uncertainty for a weighted fit.
+        self._weighted = weighted
+        self._settings = _decomposer_settings(solver, solver_options)
+        sigma = None
+        if weighted:
+            sigma = np.reshape(
+                _decomposer_sigma(self.spectrum, ordinate.unit).value,
+                pool_shape.shape,
+            )
+
         # Pick and load the precomputed matrix.
-        local_pkl = Picker().pick(version)
-        with open(local_pkl, "rb") as f:
-            self._precomputed = pickle.load(f, encoding="latin1")
+        self._precomputed = _decomposer_load(version)
 
         # Linearly interpolate the precomputed spectra onto the
         # frequency grid of the input spectrum.
-        decomposer_interp = partial(
-            _decomposer_interp, x=abscissa, xp=self._precomputed["abscissa"] / u.cm
+        self._matrix = _decomposer_matrix(self._precomputed, abscissa, dtype=dtype)
+
+        # Perform the fit, reusing cached weights when available.
+        timings = np.zeros(n_elements_yz)
+        chi2 = np.full(n_elements_yz, np.nan)
+        ratios = variance = None
+        if uncertainties:
+            ratios = _decomposer_ratios(self._precomputed)[1]
+            variance = np.full((n_elements_yz, len(ratios[0])), np.nan)
+        self._weights = _decomposer_weights(
+            self._matrix,
+            pool_shape,
+            self._mask,
+            abscissa,
+            ordinate.unit,
+            self._settings,
+            cache=cache,
+            timings=timings,
+            chi2=chi2,
+            sigma=sigma,
+            ratios=ratios,
+            variance=variance,
         )
 
-        # Create multiprocessing pool.
-        pool = multiprocessing.Pool(processes=multiprocessing.cpu_count() - 1)
-        self._matrix = pool.map(decomposer_interp, self._precomputed["matrix"].T)
-        pool.close()
-        pool.join()
-        self._matrix = np.array(self._matrix).T
-
-        # Copy and normalize the matrix.
-        m = self._matrix.copy()
-        m_scl = m.max()
-        m /= m_scl
+        # Reshape results.
+        new_shape = ordinate.shape[1:] + (self._matrix.shape[1],)
+        self._weights = np.transpose(np.reshape(self._weights, new_shape), (2, 0, 1))
+        self._timings = np.reshape(timings, ordinate.shape[1:])
+        self._chi2 = np.reshape(chi2, ordinate.shape[1:])
+        self._variance = variance
+        if variance is not None:
+            self._variance = np.reshape(variance, ordinate.shape[1:] + (-1,))
 
-        # Normalize spectral input.
-        b_scl = np.max(pool_shape, axis=0).value
-        np.divide(pool_shape, b_scl[None, :], out=pool_shape, where=self._mask)
+    def update(self, spectrum, cache=None):
+        """Refit only the pixels that changed in an updated spectrum.
 
-        # Setup the fitter.
-        decomposer_nnls = partial(_decomposer_nnls, m=m)
-        pool = multiprocessing.Pool(processes=multiprocessing.cpu_count() - 1)
+        The spectral axis, units and spatial shape must be unchanged.
+        The weights and the already computed spectral breakdowns are
+        updated in place for the changed pixels, while the other cached
+        properties are computed anew on next access.
 
-        # Perform the fit.
-        weights, _ = list(zip(*pool.map(decomposer_nnls, pool_shape[:, self._mask].T)))
-        pool.close()
-        pool.join()
+        Args:
+            spectrum (specutil.Spectrum): The updated spectrum.
+            cache (ResultCache): Optional, cache of fitted weights.
 
-        # Scale weights back.
-        weights = np.array(weights)
-        weights /= m_scl / b_scl[self._mask, None]
+        Returns:
+            numpy.ndarray: The map of changed pixels.
+        """
+        if (
+            spectrum.flux.shape != self.spectrum.flux.shape
+            or spectrum.flux.unit != self.spectrum.flux.unit
+            or not np.array_equal(
+                spectrum.spectral_axis.value, self.spectrum.spectral_axis.value
+            )
+            or spectrum.spectral_axis.unit != self.spectrum.spectral_axis.unit
+        ):
+            raise ValueError("spectral axis, units or shape changed")
+
+        # Compare the flux pixel-by-pixel, treating NaNs as equal.
+        old = self.spectrum.flux.value.T
+        new = spectrum.flux.value.T
+        changed = np.any((old != new) & ~(np.isnan(old) & np.isnan(new)), axis=0)
+        if self._weighted:
+            old = self.spectrum.uncertainty.array.T
+            new = spectrum.uncertainty.array.T
+            changed |= np.any((old != new) & ~(np.isnan(old) & np.isnan(new)), axis=0)
 
-        # Set weights.
-        self._weights = np.zeros((pool_shape.shape[1], self._matrix.shape[1]))
-        self._weights[self._mask] = weights
+        self.spectrum = spectrum
+        if not np.any(changed):
+            return changed
+
+        # Refit the changed pixels only.
+        abscissa, ordinate = _decomposer_convert(spectrum)
+        y, x = np.nonzero(changed)
+        pool_shape = ordinate[:, y, x]
+        mask = _decomposer_mask(pool_shape)
+        sigma = None
+        if self._weighted:
+            sigma = _decomposer_sigma(spectrum, ordinate.unit).value[:, y, x]
+        timings = np.zeros(len(y))
+        chi2 = np.full(len(y), np.nan)
+        ratios = variance = None
+        if self._variance is not None:
+            ratios = _decomposer_ratios(self._precomputed)[1]
+            variance = np.full((len(y), len(ratios[0])), np.nan)
+        weights = _decomposer_weights(
+            self._matrix,
+            pool_shape,
+            mask,
+            abscissa,
+            ordinate.unit,
+            self._settings,
+            cache=cache,
+            timings=timings,
+            chi2=chi2,
+            sigma=sigma,
+            ratios=ratios,
+            variance=variance,
+        )
 
-        # Reshape results.
-        new_shape = ordinate.shape[1:] + (self._matrix.shape[1],)
-        self._weights = np.transpose(np.reshape(self._weights, new_shape), (2, 0, 1))
+        self._weights[:, y, x] = weights.T
+        self._timings[y, x] = timings
+        self._chi2[y, x] = chi2
+        if variance is not None:
+            self._variance[y, x] = variance
+        self._mask[np.ravel_multi_index((y, x), changed.shape)] = mask
+
+        # Update the spectral breakdowns in place, when already computed.
+        charge = self._precomputed["properties"]["charge"]
+        size = self._precomputed["properties"]["size"]
+        selections = {
+            "fit": {None: np.ones(charge.shape, dtype=bool)},
+            "charge": _decomposer_charges(charge),
+            "size": _decomposer_sizes(size),
+        }
+        for name, selection in selections.items():
+            if name not in self.__dict__:
+                continue
+            for key, select in selection.items():
+                spectra = self.__dict__[name] if key is None else self.__dict__[name][key]
+                spectra[:, y, x] = (
+                    self._matrix.dot(weights.T * select[:, None]) * mask
+                ) * spectra.unit
+
+        # Drop the other cached properties.
+        for cls in type(self).__mro__:
+            for name, value in vars(cls).items():
+                if isinstance(value, cached_property) and name not in selections:
+                    self.__dict__.pop(name, None)
+
+        return changed
 
     @cached_property
     def fit(self):
@@ -173,9 +1568,8 @@ class DecomposerBase(object):
 
         decomposer_fit = partial(_decomposer_fit, m=self._matrix)
 
-        # Create multiprocessing pool.
-        n_cpus = multiprocessing.cpu_count()
-        pool = multiprocessing.Pool(processes=n_cpus - 1)
+        # Use the shared multiprocessing pool.
+        pool = _decomposer_pool()
 
         # Convenience defintions.
         ordinate = self.spectrum.flux.T
@@ -183,12 +1577,11 @@ class DecomposerBase(object):
         wt_shape = np.reshape(self._weights, (self._weights.shape[0], wt_elements_yz))
 
         # Perform the fit.
-        yfit = np.zeros((wt_elements_yz, ordinate.shape[0]))
-        yfit[self._mask, :] = np.array(
-            pool.map(decomposer_fit, wt_shape[:, self._mask].T)
-        )
-        pool.close()
-        pool.join()
+        yfit = np.zeros((wt_elements_yz, ordinate.shape[0]), dtype=self._matrix.dtype)
+        if np.any(self._mask):
+            yfit[self._mask, :] = np.array(
+                pool.map(decomposer_fit, wt_shape[:, self._mask].T)
+            )
 
         # Reshape results.
         new_shape = ordinate.shape[1:] + (ordinate.shape[0],)
@@ -212,12 +1605,15 @@ class DecomposerBase(object):
             1.0 / u.cm, equivalencies=u.spectral()
         )
 
-        # Convenience definition.
+        # Convenience definition, leaving out non-finite channels.
         ordinate = self.spectrum.flux.T
+        valid = np.isfinite(ordinate)
+        residual = np.where(valid, np.abs(self.fit - ordinate), 0.0)
+        ordinate = np.where(valid, ordinate, 0.0)
 
         # Use Trapezium rule to integrate the absolute of the residual
         # and the observations.
-        abs_residual = np.trapezoid(np.abs(self.fit - ordinate), x=abscissa, axis=0)
+        abs_residual = np.trapezoid(residual, x=abscissa, axis=0)
 
         total = np.trapezoid(ordinate, x=abscissa, axis=0)
 
@@ -246,10 +1642,10 @@ class DecomposerBase(object):
         """
 
         # Compute ionized fraction.
-        charge_matrix = self._precomputed["properties"]["charge"]
-        neutrals = (charge_matrix == 0).astype(float)[:, None, None]
-        cations = (charge_matrix > 0).astype(float)[:, None, None]
-        anions = (charge_matrix < 0).astype(float)[:, None, None]
+        charges = _decomposer_charges(self._precomputed["properties"]["charge"])
+        neutrals = charges["neutral"].astype(float)[:, None, None]
+        cations = charges["cation"].astype(float)[:, None, None]
+        anions = charges["anion"].astype(float)[:, None, None]
         neutral_fraction = np.sum(self._weights * neutrals, axis=0)
         cation_fraction = np.sum(self._weights * cations, axis=0)
         anion_fraction = np.sum(self._weights * anions, axis=0)
@@ -305,20 +1701,18 @@ class DecomposerBase(object):
         """
 
         # Compute large fraction.
-        size_matrix = self._precomputed["properties"]["size"]
-        large = (size_matrix > MEDIUM_SIZE).astype(float)[:, None, None]
+        sizes = _decomposer_sizes(self._precomputed["properties"]["size"])
+        large = sizes["large"].astype(float)[:, None, None]
         large_fraction = np.sum(self._weights * large, axis=0)
         large_fraction *= u.dimensionless_unscaled
 
         # Compute medium fraction between 50 and 70.
-        medium = ((size_matrix > SMALL_SIZE) & (size_matrix <= MEDIUM_SIZE)).astype(
-            float
-        )[:, None, None]
+        medium = sizes["medium"].astype(float)[:, None, None]
         medium_fraction = np.sum(self._weights * medium, axis=0)
         medium_fraction *= u.dimensionless_unscaled
 
         # Compute small fraction between 20 and 50.
-        small = (size_matrix <= SMALL_SIZE).astype(float)[:, None, None]
+        small = sizes["small"].astype(float)[:, None, None]
         small_fraction = np.sum(self._weights * small, axis=0)
         small_fraction *= u.dimensionless_unscaled
 
@@ -366,9 +1760,8 @@ class DecomposerBase(object):
             p=self._precomputed["properties"]["charge"],
         )
 
-        # Create multiprocessing pool.
-        n_cpus = multiprocessing.cpu_count()
-        pool = multiprocessing.Pool(processes=n_cpus - 1)
+        # Use the shared multiprocessing pool.
+        pool = _decomposer_pool()
 
         # Convenience definitions.
         wt_shape_yz = self._weights.shape[1] * self._weights.shape[2]
@@ -382,15 +1775,13 @@ class DecomposerBase(object):
 
         # Map the charge arrays.
         charge = {
-            charge: np.zeros((wt_shape_yz, ordinate.shape[0]))
+            charge: np.zeros((wt_shape_yz, ordinate.shape[0]), dtype=self._matrix.dtype)
             for charge in mappings.keys()
         }
         for c, func in mappings.items():
             charge[c][self._mask, :] = np.array(
                 pool.map(func, new_dims[:, self._mask].T)
             )
-        pool.close()
-        pool.join()
 
         # Reshape results and set units.
         interior = ordinate.shape[1:] + (ordinate.shape[0],)
@@ -441,17 +1832,15 @@ class DecomposerBase(object):
 
         # Map the size arrays.
         size = {
-            size: np.zeros((wt_shape_yz, ordinate.shape[0])) for size in mappings.keys()
+            size: np.zeros((wt_shape_yz, ordinate.shape[0]), dtype=self._matrix.dtype)
+            for size in mappings.keys()
         }
 
-        # Create multiprocessing pool.
-        n_cpus = multiprocessing.cpu_count()
-        pool = multiprocessing.Pool(processes=n_cpus - 1)
+        # Use the shared multiprocessing pool.
+        pool = _decomposer_pool()
 
         for s, func in mappings.items():
             size[s][self._mask, :] = np.array(pool.map(func, new_dims[:, self._mask].T))
-        pool.close()
-        pool.join()
 
         # Reshape results and set units.
         interior = ordinate.shape[1:] + (ordinate.shape[0],)
@@ -463,6 +1852,187 @@ class DecomposerBase(object):
 
         return size
 
+    def monte_carlo(
+        self, n=100, percentiles=(16.0, 50.0, 84.0), time_budget=None, seed=None
+    ):
+        """Estimate the uncertainties of the fractions and the average
+        number of carbon atoms by resampling.
+
+        The spectrum is perturbed n times by its uncertainty and all
+        realizations are fitted as batched NNLS problems, sharing the
+        interpolated matrix, in the shared pool. With a time budget, a
+        single realization is timed first and the others are fitted in
+        rounds sized from the time per realization so far, such that no
+        round is expected to overrun the budget.
+
+        Args:
+            n (int): The number of realizations (defaults to 100).
+            percentiles (tuple): The percentiles to report (defaults to
+                16, 50 and 84).
+            time_budget (float): Optional, the time budget in seconds.
+            seed (int): Optional, seed of the random number generator.
+
+        Returns:
+            dict: The percentile maps, as (n_percentiles, ny, nx), of
+            the 'charge_fractions', 'size_fractions' and 'nc', and the
+            number of 'realizations' fitted.
+        """
+        start = time.perf_counter()
+        rng = np.random.default_rng(seed)
+
+        # Convenience definitions.
+        _, ordinate = _decomposer_convert(self.spectrum)
+        pool_shape = np.reshape(ordinate.value, (ordinate.shape[0], -1))
+        sigma = np.reshape(
+            _decomposer_sigma(self.spectrum, ordinate.unit).value, pool_shape.shape
+        )
+        index = np.flatnonzero(self._mask)
+        y = pool_shape[:, index]
+        sigma = sigma[:, index]
+        noise = np.nan_to_num(sigma, nan=0.0, posinf=0.0, neginf=0.0)
+        keys, (numerators, denominator) = _decomposer_ratios(self._precomputed)
+
+        # Limit each round to about 64 MB of spectra.
+        per_realization = None
+        per_round = max(1, int(2**26 // max(1, y.size * 8)))
+
+        samples = []
+        done = 0
+        while done < n:
+            size = min(n - done, per_round)
+            if time_budget is not None:
+                remaining = time_budget - (time.perf_counter() - start)
+                if per_realization is None:
+                    size = 1
+                else:
+                    size = min(size, int(remaining // per_realization))
+                if size < 1 or remaining <= 0:
+                    break
+
+            # Perturb and fit the realizations as one batch.
+            batch = y[None] + rng.standard_normal((size,) + y.shape) * noise
+            batch = np.reshape(np.transpose(batch, (1, 0, 2)), (y.shape[0], -1))
+            mask = _decomposer_mask(batch)
+            t = time.perf_counter()
+            weights = _decomposer_solve(
+                self._matrix,
+                batch,
+                mask,
+                sigma=np.tile(sigma, size) if self._weighted else None,
+                **self._settings,
+            )
+            per_realization = (time.perf_counter() - t) / size
+
+            # Compute the fractions and the average number of carbon
+            # atoms of each realization.
+            weights = np.reshape(weights, (size, len(index), -1)).astype(np.float64)
+            total = weights @ denominator
+            with np.errstate(invalid="ignore", divide="ignore"):
+                ratios = (weights @ numerators.T) / total[..., None]
+            ratios[np.reshape(~mask, (size, len(index)))] = np.nan
+            samples.append(ratios)
+            done += size
+
+        # Compute the percentile maps.
+        maps = np.full(
+            (len(percentiles), pool_shape.shape[1], len(keys)), np.nan
+        )
+        if samples:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                maps[:, index] = np.nanpercentile(
+                    np.concatenate(samples), percentiles, axis=0
+                )
+        maps = np.reshape(maps, (len(percentiles),) + ordinate.shape[1:] + (-1,))
+
+        results = {"realizations": done}
+        for i, (prop, key) in enumerate(keys):
+            value = maps[..., i] * u.dimensionless_unscaled
+            if key is None:
+                results[prop] = value
+            else:
+                results.setdefault(prop, {})[key] = value
+
+        return results
+
+    def _uncertainty(self, name):
+        """Return the propagated 1-sigma uncertainty of a property."""
+        keys, _ = _decomposer_ratios(self._precomputed)
+        uncertainty = {}
+        for i, (prop, key) in enumerate(keys):
+            if prop != name:
+                continue
+            if self._variance is None:
+                std = np.full(self._weights.shape[1:], np.nan)
+            else:
+                std = np.sqrt(self._variance[..., i])
+            uncertainty[key] = std * u.dimensionless_unscaled
+
+        return uncertainty.get(None, uncertainty)
+
+    @cached_property
+    def charge_fractions_uncertainty(self):
+        """Return the uncertainty of the charge fractions.
+
+        The covariance of the fitted weights is propagated linearly,
+        when the decomposition was made with uncertainties=True; the
+        uncertainties are NaN otherwise and for pixels that were not
+        fitted or taken from the cache of fitted weights.
+
+        Returns:
+            dict: 1-sigma uncertainty of the neutral, cation and anion
+            fractions.
+        """
+        return self._uncertainty("charge_fractions")
+
+    @cached_property
+    def size_fractions_uncertainty(self):
+        """Return the uncertainty of the size fractions.
+
+        See charge_fractions_uncertainty.
+
+        Returns:
+            dict: 1-sigma uncertainty of the large, medium and small
+            fractions.
+        """
+        return self._uncertainty("size_fractions")
+
+    @cached_property
+    def nc_uncertainty(self):
+        """Return the uncertainty of the average number of carbon atoms.
+
+        See charge_fractions_uncertainty.
+
+        Returns:
+            quantity.Quantity: 1-sigma uncertainty of the average number
+            of carbon atoms.
+        """
+        return self._uncertainty("nc")
+
+    @property
+    def solve_time(self):
+        """Return the NNLS solve time of each pixel.
+
+        Pixels that were not fitted or taken from the cache of fitted
+        weights have zero solve time; unknown times are NaN.
+
+        Returns:
+            quantity.Quantity: The solve time map.
+        """
+        return self._timings * u.s
+
+    @property
+    def chi2(self):
+        """Return the chi-square of the weighted fit of each pixel.
+
+        Pixels that were not fitted, fitted unweighted or taken from the
+        cache of fitted weights have a NaN chi-square.
+
+        Returns:
+            quantity.Quantity: The chi-square map.
+        """
+        return self._chi2 * u.dimensionless_unscaled
+
     @cached_property
     def mask(self):
         """Return the computed mask."""
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+decomposer_batch.py
+
+Fit and decompose many spectra at once, sharing the precomputed matrix
+between all spectra and the interpolated matrix between spectra on the
+same spectral grid.
+
+This file is part of pypahdb - see the module docs for more
+information.
+"""
+import numpy as np
+from specutils import Spectrum
+
+from pypahdb.decomposer import Decomposer
+from pypahdb.decomposer_base import (
+    _decomposer_convert,
+    _decomposer_load,
+    _decomposer_mask,
+    _decomposer_matrix,
+    _decomposer_ratios,
+    _decomposer_settings,
+    _decomposer_sigma,
+    _decomposer_weights,
+    spectral_fingerprint,
+)
+
+
+class DecomposerResult(Decomposer):
+    """Decomposition result of a single spectrum from a batch.
+
+    Provides the same properties and methods as Decomposer, but shares
+    the precomputed and interpolated matrices with the other results
+    of the batch instead of owning a copy.
+    """
+
+    def __init__(
+        self,
+        spectrum,
+        precomputed,
+        matrix,
+        weights,
+        mask,
+        timings=None,
+        chi2=None,
+        weighted=False,
+        variance=None,
+        settings=None,
+    ):
+        """Initialize DecomposerResult object.
+
+        Args:
+            spectrum (specutils.Spectrum): The fitted data.
+            precomputed (dict): The precomputed matrix.
+            matrix (numpy.ndarray): The interpolated matrix.
+            weights (numpy.ndarray): The fitted weights.
+            mask (numpy.ndarray): The fitted pixels.
+            timings (numpy.ndarray): Optional, the solve time map in
+                seconds.
+            chi2 (numpy.ndarray): Optional, the chi-square map.
+            weighted (bool): Whether the fit was weighted.
+            variance (numpy.ndarray): Optional, the variance of the ratios
+                of the weights.
+            settings (dict): Optional, the solver settings of the fit.
+        """
+        self.spectrum = spectrum
+        self._precomputed = precomputed
+        self._matrix = matrix
+        self._weights = weights
+        self._mask = mask
+        if timings is None:
+            timings = np.full(weights.shape[1:], np.nan)
+        self._timings = timings
+        if chi2 is None:
+            chi2 = np.full(weights.shape[1:], np.nan)
+        self._chi2 = chi2
+        self._weighted = weighted
+        self._variance = variance
+        self._settings = {} if settings is None else settings
+
+
+def decompose_batch(
+    spectra,
+    version=None,
+    cache=None,
+    matrices=None,
+    dtype=np.float64,
+    weighted=False,
+    uncertainties=False,
+    solver="nnls",
+    solver_options=None,
+):
+    """Fit and decompose many spectra.
+
+    The precomputed matrix is loaded once. Spectra sharing a spectral
+    grid and flux unit are fitted together as a single NNLS batch, and
+    the matrix is interpolated once per grid. A spectrum that cannot be
+    converted or weighted is left out without affecting the others.
+
+    Args:
+        spectra (list): The specutils.Spectrum objects to fit.
+        version (str): The version of the precomputed matrix to use.
+        cache (ResultCache): Optional, cache of fitted weights.
+        matrices (dict): Optional, the precomputed and interpolated
+            matrices keyed by version, grid fingerprint and dtype, reused
+            and updated in place. An OrderedDict is kept in
+            least-recently-used order.
+        dtype (numpy.dtype): The dtype of the interpolated matrix, the
+            weights and the spectral breakdowns (defaults to
+            numpy.float64).
+        weighted (bool): Weight the fits by the uncertainty of the
+            spectra (defaults to False).
+        uncertainties (bool): Propagate the covariance of the fits to the
+            uncertainties of the fractions and the average number of
+            carbon atoms (defaults to False).
+        solver (str): The solver, either 'nnls', 'qr', 'pg' or 'reduced'
+            (defaults to 'nnls').
+        solver_options (dict): Optional, the options of the solver.
+
+    Returns:
+        list: A DecomposerResult for each spectrum, in order, or None
+        when a spectrum could not be fitted.
+    """
+    results = [None] * len(spectra)
+    settings = _decomposer_settings(solver, solver_options)
+
+    # Group the spectra by their spectral grid.
+    groups = {}
+    for i, spectrum in enumerate(spectra):
+        if not isinstance(spectrum, Spectrum):
+            print(f"spectrum {i} is not a specutils.Spectrum")
+            continue
+
+        if weighted and spectrum.uncertainty is None:
+            print(f"spectrum {i} has no uncertainty")
+            continue
+
+        fingerprint = spectral_fingerprint(spectrum.spectral_axis, spectrum.flux.unit)
+        groups.setdefault(fingerprint, []).append(i)
+
+    if not groups:
+        return results
+
+    # Pick and load the precomputed matrix.
+    precomputed = _decomposer_load(version)
+
+    for members in groups.values():
+        # Convert units and stack the spectra as (n_wave, n_spectra),
+        # leaving out those that cannot be converted.
+        converted = []
+        ordinates = []
+        sigmas = []
+        for i in members:
+            try:
+                abscissa, ordinate = _decomposer_convert(spectra[i])
+                if weighted:
+                    sigmas.append(_decomposer_sigma(spectra[i], ordinate.unit).value)
+            except Exception as e:
+                print(f"spectrum {i} could not be converted: {e}")
+                continue
+            converted.append(i)
+            ordinates.append(ordinate)
+        if not converted:
+            continue
+        members = converted
+        units = {str(o.unit) for o in ordinates}
+        pool_shape = np.concatenate(
+            [np.reshape(o.value, (o.shape[0], -1)) for o in ordinates], axis=1
+        )
+        sigma = None
+        if weighted:
+            sigma = np.concatenate(
+                [np.reshape(s, (s.shape[0], -1)) for s in sigmas], axis=1
+            )
+
+        # Avoid fitting -zero- spectra.
+        mask = _decomposer_mask(pool_shape)
+
+        # Interpolate once and fit the entire group.
+        fingerprint = spectral_fingerprint(spectra[members[0]].spectral_axis)
+        key = (precomputed.get("version"), fingerprint, np.dtype(dtype).str)
+        if matrices is not None and key in matrices and matrices[key][0] is precomputed:
+            matrix = matrices[key][1]
+            if hasattr(matrices, "move_to_end"):
+                matrices.move_to_end(key)
+        else:
+            matrix = _decomposer_matrix(precomputed, abscissa, dtype=dtype)
+            if matrices is not None:
+                matrices[key] = (precomputed, matrix)
+        timings = np.zeros(pool_shape.shape[1])
+        chi2 = np.full(pool_shape.shape[1], np.nan)
+        ratios = variance = None
+        if uncertainties:
+            ratios = _decomposer_ratios(precomputed)[1]
+            variance = np.full((pool_shape.shape[1], len(ratios[0])), np.nan)
+        weights = _decomposer_weights(
+            matrix,
+            pool_shape,
+            mask,
+            abscissa,
+            "|".join(sorted(units)),
+            settings,
+            cache=cache,
+            timings=timings,
+            chi2=chi2,
+            sigma=sigma,
+            ratios=ratios,
+            variance=variance,
+        )
+
+        # Split the results over the spectra.
+        start = 0
+        for i, ordinate in zip(members, ordinates):
+            stop = start + ordinate.shape[1] * ordinate.shape[2]
+            new_shape = ordinate.shape[1:] + (matrix.shape[1],)
+            results[i] = DecomposerResult(
+                spectra[i],
+                precomputed,
+                matrix,
+                np.transpose(np.reshape(weights[start:stop], new_shape), (2, 0, 1)),
+                mask[start:stop],
+                np.reshape(timings[start:stop], ordinate.shape[1:]),
+                np.reshape(chi2[start:stop], ordinate.shape[1:]),
+                weighted,
+                (
+                    None
+                    if variance is None
+                    else np.reshape(variance[start:stop], ordinate.shape[1:] + (-1,))
+                ),
+                settings,
+            )
+            start = stop
+
+    return results
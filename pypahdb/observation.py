@@ -18,23 +18,33 @@ from astropy.io.registry import IORegistryError
 from astropy.nddata import StdDevUncertainty
 from specutils import Spectrum
 
+# The JWST data quality flag marking samples not to be used.
+DO_NOT_USE = 1
+
 
 class Observation(object):
     """Creates an Observation object.
 
     Reads IPAC tables, Spitzer-IRS data cubes, and JWST spectra.
 
+    The flux of samples flagged in a data quality (DQ) array is set to
+    NaN, so they are left out of the decomposition, and the ERR array
+    is carried as the uncertainty.
+
     Attributes:
         spectrum (specutils.Spectrum): contains loaded spectrum.
     """
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, dq_flags=DO_NOT_USE):
         """Instantiate an Observation object.
 
         Args:
             file_path (str): String of file to load.
+            dq_flags (int): Bitmask of the DQ flags to reject (defaults
+                to DO_NOT_USE).
         """
         self.file_path = file_path
+        self.dq_flags = dq_flags
 
         # TODO: implement try-except block for reading in pyPAHFit results
 
@@ -49,17 +59,23 @@ class Observation(object):
 
             # Always work as if spectrum is a cube.
             if len(self.spectrum.flux.shape) == 1:
+                shape = (1, 1) + self.spectrum.flux.shape
+                unc = None
+                if self.spectrum.uncertainty is not None:
+                    unc = self.spectrum.uncertainty.__class__(
+                        np.reshape(self.spectrum.uncertainty.array, shape),
+                        unit=self.spectrum.uncertainty.unit,
+                    )
+                mask = None
+                if self.spectrum.mask is not None:
+                    mask = np.reshape(self.spectrum.mask, shape)
                 self.spectrum = Spectrum(
-                    flux=np.reshape(
-                        self.spectrum.flux,
-                        (
-                            1,
-                            1,
-                        )
-                        + self.spectrum.flux.shape,
-                    ),
+                    flux=np.reshape(self.spectrum.flux, shape),
                     spectral_axis=self.spectrum.spectral_axis,
+                    uncertainty=unc,
+                    mask=mask,
                 )
+            self._mask_dq()
 
             if "header" in self.spectrum.meta:
                 self.header = self.spectrum.meta["header"]
@@ -118,7 +134,19 @@ class Observation(object):
                             h.header["CRVAL3"]
                             + h.header["CDELT3"] * np.arange(0, h.header["NAXIS3"])
                         ) * u.Unit(h.header["CUNIT3"])
-                        self.spectrum = Spectrum(flux, spectral_axis=wave)
+
+                        # Carry the JWST ERR and DQ extensions.
+                        unc = None
+                        if "ERR" in hdu and hdu["ERR"].data is not None:
+                            unc = StdDevUncertainty(hdu["ERR"].data.T * flux.unit)
+                        mask = None
+                        if "DQ" in hdu and hdu["DQ"].data is not None:
+                            mask = hdu["DQ"].data.T
+
+                        self.spectrum = Spectrum(
+                            flux, spectral_axis=wave, uncertainty=unc, mask=mask
+                        )
+                        self._mask_dq()
 
                         return None
 
@@ -170,3 +198,20 @@ class Observation(object):
         # Like astropy.io we, simply raise a generic OSError when
         # we fail to read the file.
         raise OSError(str(self.file_path) + ": Format not recognized")
+
+    def _mask_dq(self):
+        """Set the flux of flagged samples to NaN.
+
+        An integer mask is taken as a DQ array and tested against
+        dq_flags, a boolean mask is used as is.
+        """
+        if self.spectrum.mask is None:
+            return
+
+        mask = np.asarray(self.spectrum.mask)
+        if mask.dtype != bool:
+            mask = (mask.astype(np.int64) & self.dq_flags) != 0
+
+        if np.any(mask):
+            self.spectrum.data[mask] = np.nan
+        self.spectrum.mask = mask
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+observation_batch.py
+
+Reads many astronomical observations in parallel and stacks them into
+pseudo-cubes, one per spectral grid.
+
+This file is part of pypahdb - see the module docs for more
+information.
+"""
+import multiprocessing
+import os
+from glob import glob, has_magic
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from astropy.nddata import StdDevUncertainty
+from specutils import Spectrum
+
+from pypahdb.decomposer_base import spectral_fingerprint
+from pypahdb.observation import Observation
+
+
+def _observation_batch_read(file_path):
+    """Read a single observation in a pool worker.
+
+    Spectrum objects cannot be pickled, hence only their plain
+    quantities are returned.
+    """
+    try:
+        obs = Observation(file_path)
+    except Exception as e:
+        return file_path, None, None, e
+
+    spectrum = obs.spectrum
+    unc = None
+    if spectrum.uncertainty is not None:
+        unc = spectrum.uncertainty.quantity
+
+    data = {
+        "flux": spectrum.flux,
+        "spectral_axis": spectrum.spectral_axis.quantity,
+        "uncertainty": unc,
+        "colnames": spectrum.meta.get("colnames", 3 * [""]),
+    }
+
+    return file_path, data, obs.header, None
+
+
+class ObservationBatch(object):
+    """Creates an ObservationBatch object.
+
+    Reads many files in a thread or process pool and stacks their
+    spectra into pseudo-cubes, one for each distinct spectral grid.
+    The flux of a group has shape (n_spectra, 1, n_wave), so the
+    pseudo-cubes can be passed to Decomposer as-is and the resulting
+    maps have shape (1, n_spectra).
+
+    Attributes:
+        file_paths (list): Paths of the successfully read files.
+        spectra (list): One specutils.Spectrum pseudo-cube per grid.
+        fingerprints (list): The grid fingerprint of each pseudo-cube.
+        headers (list): The header of each successfully read file.
+        index (list): For each file, a tuple (group, start, stop, shape)
+            locating its spectra in the pseudo-cubes, where shape is
+            the spatial shape of the file's flux.
+        failures (dict): Exception raised for each unreadable file.
+    """
+
+    def __init__(self, files, workers=None, processes=False):
+        """Instantiate an ObservationBatch object.
+
+        Args:
+            files (str or list): Paths and/or glob patterns of the files
+                to load.
+
+        Keywords:
+            workers (int): Size of the pool (defaults to the number of
+                CPUs).
+            processes (bool): Read using processes instead of threads
+                (defaults to False).
+        """
+        if isinstance(files, (str, os.PathLike)):
+            files = [files]
+
+        file_paths = []
+        for f in files:
+            if isinstance(f, str) and has_magic(f):
+                file_paths += sorted(glob(f))
+            else:
+                file_paths.append(f)
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = max(1, min(workers, len(file_paths)))
+
+        if processes:
+            pool = multiprocessing.Pool(processes=workers)
+        else:
+            pool = ThreadPool(processes=workers)
+        results = pool.map(_observation_batch_read, file_paths)
+        pool.close()
+        pool.join()
+
+        self.file_paths = []
+        self.spectra = []
+        self.fingerprints = []
+        self.headers = []
+        self.index = []
+        self.failures = {}
+
+        # Group the spectra by their spectral grid, in order of appearance.
+        groups = {}
+        spectra = []
+        for file_path, data, header, error in results:
+            if error is not None:
+                self.failures[file_path] = error
+                continue
+
+            fingerprint = spectral_fingerprint(
+                data["spectral_axis"], data["flux"].unit
+            )
+            groups.setdefault(fingerprint, []).append(len(spectra))
+            spectra.append(data)
+            self.file_paths.append(file_path)
+            self.headers.append(header)
+            self.index.append(None)
+
+        for g, (fingerprint, members) in enumerate(groups.items()):
+            start = 0
+            flux = []
+            unc = []
+            first = spectra[members[0]]
+            n_wave = first["flux"].shape[-1]
+            for i in members:
+                shape = spectra[i]["flux"].shape[:-1]
+                n_spectra = int(np.prod(shape))
+                flux.append(
+                    np.reshape(
+                        spectra[i]["flux"].to_value(first["flux"].unit),
+                        (n_spectra, n_wave),
+                    )
+                )
+                if spectra[i]["uncertainty"] is not None:
+                    unc.append(
+                        np.reshape(
+                            spectra[i]["uncertainty"].to_value(first["flux"].unit),
+                            (n_spectra, n_wave),
+                        )
+                    )
+                self.index[i] = (g, start, start + n_spectra, shape)
+                start += n_spectra
+
+            uncertainty = None
+            if len(unc) == len(members):
+                uncertainty = StdDevUncertainty(
+                    np.concatenate(unc)[:, None, :] * first["flux"].unit
+                )
+
+            self.spectra.append(
+                Spectrum(
+                    flux=np.concatenate(flux)[:, None, :] * first["flux"].unit,
+                    spectral_axis=first["spectral_axis"],
+                    uncertainty=uncertainty,
+                )
+            )
+            self.spectra[-1].meta["colnames"] = first["colnames"]
+            self.fingerprints.append(fingerprint)
+
+    def __len__(self):
+        """Return the number of successfully read files."""
+        return len(self.file_paths)
+
+    def locate(self, i):
+        """Locate the spectra of a file in the pseudo-cubes.
+
+        Args:
+            i (int): Index of the file in file_paths.
+
+        Returns:
+            tuple: The group and the slice along the first axis of the
+            group's pseudo-cube flux.
+        """
+        group, start, stop, _ = self.index[i]
+
+        return group, slice(start, stop)
+
+    def unstack(self, i, data):
+        """Extract the result of a file from a per-group result map.
+
+        Args:
+            i (int): Index of the file in file_paths.
+            data (numpy.ndarray): Map of the file's group with shape
+                (..., 1, n_spectra), e.g., Decomposer.nc.
+
+        Returns:
+            numpy.ndarray: The map laid out as if the file had been
+            decomposed on its own.
+        """
+        _, start, stop, shape = self.index[i]
+
+        return np.swapaxes(
+            np.reshape(data[..., 0, start:stop], data.shape[:-2] + shape), -1, -2
+        )
@@ -8,36 +8,365 @@ spectrum.
 This file is part of pypahdb - see the module docs for more
 information.
 """
+import hashlib
 import json
+import math
 import os
+import pathlib
+import pickle
+import tempfile
+import time
+from contextlib import contextmanager
 from glob import glob
-from urllib.request import urlretrieve
+from urllib.request import urlopen
 
 import importlib_resources
-from tqdm import tqdm
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    import msvcrt
+
+    fcntl = None
 
 RELEASES_URL = "https://www.astrochemistry.org/pahdb/pypahdb/releases.json"
 
+RELEASES_TTL = 86400
+
+DOWNLOAD_TIMEOUT = 60.0
+
+
+@contextmanager
+def _locked(filename):
+    """Hold an exclusive lock on filename + '.lock' while in context.
+
+    Concurrent requesters, whether threads or processes, block until the
+    lock is released. The lock is released by the OS should its holder
+    die.
+    """
+    with open(f"{filename}.lock", "a+b") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            delay = 0.01
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(delay)
+                    delay = min(2.0 * delay, 1.0)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _env_seconds(name, default):
+    """Return the non-negative number of seconds in environment variable
+    name, or default when it is unset or empty."""
+    value = os.getenv(name, "").strip()
+    if not value:
+        return default
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = -1.0
+    if not math.isfinite(seconds) or seconds < 0.0:
+        raise ValueError(
+            f"{name} must be a non-negative number of seconds, not {value!r}"
+        )
+
+    return seconds
+
+
+def _sha256(filename):
+    """Return the SHA-256 checksum of filename."""
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def _verified(filename, sha256=None):
+    """Return whether filename is a complete install.
+
+    The file is checked against the expected checksum, when given, and
+    otherwise against the size and checksum recorded in filename +
+    '.sha256' when it was installed. Files without either are not
+    trusted.
+    """
+    record_file = f"{filename}.sha256"
+    try:
+        with open(record_file, "r") as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        record = None
+
+    if sha256 is None:
+        if not isinstance(record, dict) or "sha256" not in record:
+            return False
+        if os.path.getsize(filename) != record.get("bytes"):
+            return False
+        sha256 = record["sha256"]
+
+    actual = _sha256(filename)
+    if actual != sha256:
+        return False
+
+    if record is None:
+        try:
+            _record(filename, actual)
+        except OSError:
+            pass
+
+    return True
+
+
+def _record(filename, sha256):
+    """Record the size and checksum of an installed filename."""
+    with open(f"{filename}.sha256", "w") as f:
+        json.dump({"sha256": sha256, "bytes": os.path.getsize(filename)}, f)
+
 
 class Picker(object):
     """Pick the precomputed matrix to use for decomposing an astronomical
     spectrum.
 
+    The precomputed matrices are searched for in, in order, the
+    directories listed in the PYPAHDB_MATRIX_PATH environment variable,
+    the matrix store and the package resources directory. Matrices are
+    downloaded to the matrix store, which is set with the
+    PYPAHDB_MATRIX_STORE environment variable, and otherwise is the
+    resources directory when writable or the user's cache directory.
+    The list of releases is cached in the store for RELEASES_TTL seconds,
+    which can be overridden with the PYPAHDB_RELEASES_TTL environment
+    variable. Downloads give up when the server does not respond for
+    DOWNLOAD_TIMEOUT seconds, which can be overridden with the
+    PYPAHDB_DOWNLOAD_TIMEOUT environment variable, where 0 waits
+    indefinitely. Setting
+    PYPAHDB_OFFLINE to "1" prevents any network access. Empty variables
+    count as unset.
+
     Attributes:
+       _listings: Cached directory listings, keyed by directory.
+       _offline: Whether network access is disabled.
        _pkl_files: List of already downloaded precomputed matrices.
+       _pkl_paths: Path to each already downloaded precomputed matrix.
        _releases: List of available releases.
+       _releases_ttl: Maximum age of the cached releases in seconds.
        _resources_dir: Path to the resources directory.
+       _search_paths: Directories searched for precomputed matrices.
+       _store: Directory precomputed matrices are downloaded to.
+       _timeout: Download timeout in seconds.
     """
 
+    _listings = {}
+    _offline = False
     _pkl_files = []
+    _pkl_paths = {}
     _releases = []
+    _releases_ttl = RELEASES_TTL
     _resources_dir = None
+    _search_paths = []
+    _store = None
+    _timeout = DOWNLOAD_TIMEOUT
+
+    def __init__(
+        self,
+        search_paths=None,
+        store=None,
+        offline=None,
+        releases_ttl=None,
+        timeout=None,
+    ):
+        """Pick the precomputed matrix.
 
-    def __init__(self):
-        """Pick the precomputed matrix."""
+        Keywords:
+            search_paths (list): Directories to search for precomputed
+                matrices (defaults to PYPAHDB_MATRIX_PATH).
+            store (str): Directory to download to (defaults to
+                PYPAHDB_MATRIX_STORE).
+            offline (bool): Disable network access (defaults to
+                PYPAHDB_OFFLINE).
+            releases_ttl (float): Maximum age of the cached releases in
+                seconds (defaults to PYPAHDB_RELEASES_TTL).
+            timeout (float): Download timeout in seconds (defaults to
+                PYPAHDB_DOWNLOAD_TIMEOUT).
+
+        Raises:
+            ValueError: When PYPAHDB_RELEASES_TTL or
+                PYPAHDB_DOWNLOAD_TIMEOUT is not a non-negative number.
+        """
         self._resources_dir = importlib_resources.files("pypahdb") / "resources"
 
-        self._pkl_files = glob("*.pkl", root_dir=self._resources_dir)
+        if search_paths is None:
+            search_paths = os.getenv("PYPAHDB_MATRIX_PATH", "").split(os.pathsep)
+
+        if store is None:
+            store = os.getenv("PYPAHDB_MATRIX_STORE", "").strip() or None
+        if store is None:
+            if os.access(self._resources_dir, os.W_OK):
+                store = self._resources_dir
+            else:
+                store = os.path.join(
+                    os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                    "pypahdb",
+                )
+        self._store = pathlib.Path(store)
+
+        if offline is None:
+            offline = os.getenv("PYPAHDB_OFFLINE", "").lower() in ("1", "true", "yes")
+        self._offline = offline
+
+        if releases_ttl is None:
+            releases_ttl = _env_seconds("PYPAHDB_RELEASES_TTL", RELEASES_TTL)
+        self._releases_ttl = releases_ttl
+
+        if timeout is None:
+            timeout = _env_seconds("PYPAHDB_DOWNLOAD_TIMEOUT", DOWNLOAD_TIMEOUT)
+        self._timeout = timeout or None
+
+        self._search_paths = []
+        for path in [p for p in search_paths if p] + [self._store, self._resources_dir]:
+            path = pathlib.Path(path)
+            if path not in self._search_paths:
+                self._search_paths.append(path)
+
+        # Earlier search paths take precedence.
+        self._pkl_paths = {}
+        for path in reversed(self._search_paths):
+            for pkl_file in self._list(path):
+                self._pkl_paths[pkl_file] = path / pkl_file
+        self._pkl_files = sorted(self._pkl_paths)
+
+    @classmethod
+    def _list(cls, directory):
+        """List the precomputed matrices in directory.
+
+        The listing is cached and only refreshed when the modification
+        time of the directory changes.
+        """
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return []
+        listing = cls._listings.get(str(directory))
+        if listing is None or listing[0] != mtime:
+            listing = (mtime, sorted(glob("*.pkl", root_dir=directory)))
+            cls._listings[str(directory)] = listing
+
+        return list(listing[1])
+
+    def versions(self):
+        """Return the versions of the already downloaded precomputed
+        matrices.
+
+        Returns:
+            list: The versions.
+        """
+        return [f[len("precomputed_v"): -len(".pkl")] for f in self._pkl_files]
+
+    def index(self, version=None):
+        """Return the metadata of an already downloaded precomputed matrix
+        without loading it.
+
+        The metadata is kept in a sidecar JSON-file next to the pickle and
+        is regenerated when the pickle changes.
+
+        Args:
+            version (str): The version of the precomputed matrix, defaults
+                to the latest.
+
+        Returns:
+            dict: The metadata or None when the matrix is not available.
+        """
+        if not self._pkl_files:
+            return None
+
+        if version is None:
+            pkl_file = self._pkl_files[-1]
+        else:
+            pkl_file = f"precomputed_v{version}.pkl"
+            if pkl_file not in self._pkl_files:
+                return None
+
+        pkl_file = self._pkl_paths[pkl_file]
+
+        # Fall back to the store for pickles in read-only directories.
+        idx_files = [
+            pkl_file.with_suffix(".json"),
+            self._store / pkl_file.with_suffix(".json").name,
+        ]
+
+        st = os.stat(pkl_file)
+        for idx_file in idx_files:
+            try:
+                with open(idx_file, "r") as f:
+                    index = json.load(f)
+                if (
+                    index["file"] == pkl_file.name
+                    and index["mtime"] == st.st_mtime_ns
+                    and index["bytes"] == st.st_size
+                ):
+                    return index
+            except (OSError, ValueError, KeyError):
+                pass
+
+        index = self._index(pkl_file)
+        for idx_file in idx_files:
+            try:
+                with open(idx_file, "w") as f:
+                    json.dump(index, f, indent=1)
+                break
+            except OSError:
+                pass
+
+        return index
+
+    @staticmethod
+    def _index(pkl_file):
+        """Generate the metadata of a precomputed matrix."""
+        st = os.stat(pkl_file)
+
+        with open(pkl_file, "rb") as f:
+            precomputed = pickle.load(f, encoding="latin1")
+
+        properties = {}
+        for key, value in precomputed["properties"].items():
+            value = np.asarray(value)
+            if value.dtype.kind not in "biuf" or value.size == 0:
+                continue
+            properties[key] = {"min": value.min().item(), "max": value.max().item()}
+            if value.dtype.kind in "biu":
+                unique, counts = np.unique(value, return_counts=True)
+                if len(unique) <= 16:
+                    properties[key]["counts"] = {
+                        str(k): int(n) for k, n in zip(unique, counts)
+                    }
+
+        abscissa = np.asarray(precomputed["abscissa"])
+
+        return {
+            "version": precomputed.get(
+                "version", pkl_file.name[len("precomputed_v"): -len(".pkl")]
+            ),
+            "file": pkl_file.name,
+            "mtime": st.st_mtime_ns,
+            "bytes": st.st_size,
+            "sha256": _sha256(pkl_file),
+            "shape": list(np.shape(precomputed["matrix"])),
+            "abscissa": [abscissa.min().item(), abscissa.max().item()],
+            "properties": properties,
+        }
 
     def pick(self, version=None):
         """Pick the precomputed matrix.
@@ -50,17 +379,23 @@ class Picker(object):
         """
         if self._pkl_files:
             if version is None:
-                return self._resources_dir / next(reversed(sorted(self._pkl_files)))
+                return self._pkl_paths[self._pkl_files[-1]]
             pkl_file = f"precomputed_v{version}.pkl"
-            if pkl_file in self._pkl_files:
-                return self._resources_dir / pkl_file
+            if pkl_file in self._pkl_paths:
+                return self._pkl_paths[pkl_file]
 
-        json_file = self._resources_dir / "releases.json"
-        print("downloading latests releases.json")
+        self._releases = self._releases_load()
 
-        self._download(RELEASES_URL, json_file)
-        with open(json_file, "r") as f:
-            self._releases = json.load(f)
+        if (
+            self._offline
+            and version != "picker"
+            and version not in [r["version"] for r in self._releases]
+        ):
+            raise FileNotFoundError(
+                f"precomputed matrix {version or 'of any version'} not found in "
+                f"{', '.join(map(str, self._search_paths))} "
+                "and offline mode is enabled"
+            )
 
         if (
             version is None
@@ -70,8 +405,14 @@ class Picker(object):
             version = self._menu()
 
         pkl_file = f"precomputed_v{version}.pkl"
-        if pkl_file in self._pkl_files:
-            return self._resources_dir / pkl_file
+        if pkl_file in self._pkl_paths:
+            return self._pkl_paths[pkl_file]
+
+        if self._offline:
+            raise FileNotFoundError(
+                f"{pkl_file} not found in {', '.join(map(str, self._search_paths))} "
+                "and offline mode is enabled"
+            )
 
         release = next(
             filter(lambda release: release["version"] == version, self._releases), None
@@ -83,33 +424,123 @@ class Picker(object):
         if os.getenv("GITHUB_ACTIONS") == "true":
             location += "&github_actions=true"
 
-        pkl_file = self._resources_dir / pkl_file
+        os.makedirs(self._store, exist_ok=True)
+        pkl_file = self._store / pkl_file
 
-        self._download(location, pkl_file)
+        self._install(location, pkl_file, sha256=release.get("sha256"))
 
         return pkl_file
 
+    def _releases_load(self):
+        """Load the list of releases.
+
+        A cached releases.json younger than the TTL is used without
+        touching the network. Otherwise, it is downloaded to the store,
+        falling back to a stale copy when offline or when the download
+        fails.
+
+        Returns:
+            list: The available releases.
+        """
+        json_files = [
+            path / "releases.json"
+            for path in self._search_paths
+            if os.path.isfile(path / "releases.json")
+        ]
+        json_files.sort(key=os.path.getmtime, reverse=True)
+
+        if not self._offline and (
+            not json_files
+            or time.time() - os.path.getmtime(json_files[0]) >= self._releases_ttl
+        ):
+            json_file = self._store / "releases.json"
+            try:
+                os.makedirs(self._store, exist_ok=True)
+                print("downloading latests releases.json")
+                self._install(RELEASES_URL, json_file, max_age=self._releases_ttl)
+                json_files.insert(0, json_file)
+            except OSError:
+                if not json_files:
+                    raise
+
+        if not json_files:
+            raise FileNotFoundError(
+                "releases.json not found in "
+                f"{', '.join(map(str, self._search_paths))} "
+                "and offline mode is enabled"
+            )
+
+        with open(json_files[0], "r") as f:
+            return json.load(f)
+
+    def _install(self, url, filename, sha256=None, max_age=None):
+        """Download url to filename, safe for concurrent requesters.
+
+        The download goes to a temporary file in the same directory, is
+        verified against the checksum, when given, and is then atomically
+        renamed to filename, so filename is never left truncated. The
+        size and checksum of the install are recorded next to it, so an
+        existing file is only reused when it matches the expected or the
+        recorded checksum. Concurrent requesters wait for the first and
+        reuse its download.
+
+        Args:
+            url (str): The URL to download.
+            filename (pathlib.Path): The path to install to.
+
+        Keywords:
+            sha256 (str): Expected SHA-256 checksum (defaults to None).
+            max_age (float): Download again when filename is older, in
+                seconds (defaults to None, never).
+        """
+        with _locked(filename):
+            if os.path.isfile(filename):
+                fresh = (
+                    max_age is None or time.time() - os.path.getmtime(filename) < max_age
+                )
+                if fresh and _verified(filename, sha256):
+                    return
+
+            fd, tmp_file = tempfile.mkstemp(
+                dir=os.path.dirname(filename),
+                prefix=f"{os.path.basename(filename)}.",
+                suffix=".part",
+            )
+            os.close(fd)
+            try:
+                self._download(url, tmp_file)
+                actual = _sha256(tmp_file)
+                if sha256 is not None and actual != sha256:
+                    raise OSError(f"{url}: checksum mismatch")
+                os.chmod(tmp_file, 0o644)
+                os.replace(tmp_file, filename)
+                _record(filename, actual)
+            finally:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+
     def _download(self, url, filename):
-        """Download url to filename."""
-
-        def _report(t):
-            last_b = [0]
-
-            def inner(b=1, bsize=1, tsize=None):
-                if tsize is not None:
-                    t.total = tsize
-                t.update((b - last_b[0]) * bsize)
-                last_b[0] = b
-
-            return inner
-
-        with tqdm(
-            unit="B",
-            unit_scale=True,
-            leave=False,
-            miniters=1,
-        ) as t:
-            urlretrieve(url, filename=filename, reporthook=_report(t), data=None)
+        """Download url to filename, giving up when the server stalls for
+        longer than the timeout."""
+        from tqdm import tqdm
+
+        with urlopen(url, timeout=self._timeout) as response, open(
+            filename, "wb"
+        ) as f:
+            size = response.headers.get("Content-Length")
+            size = int(size) if size else None
+            with tqdm(
+                total=size,
+                unit="B",
+                unit_scale=True,
+                leave=False,
+                miniters=1,
+            ) as t:
+                for chunk in iter(lambda: response.read(1 << 16), b""):
+                    f.write(chunk)
+                    t.update(len(chunk))
+            if size is not None and f.tell() != size:
+                raise OSError(f"{url}: download incomplete")
 
     def _menu(self):
         """Present the menu picker"""
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+result_cache.py
+
+Content-addressed on-disk cache of fitted weights, so identical spectra
+are only fitted once across runs.
+
+This file is part of pypahdb - see the module docs for more
+information.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from pypahdb.decomposer_base import _decomposer_solve
+
+
+class ResultCache(object):
+    """Cache the fitted weights of individual spectra on disk.
+
+    Entries are keyed by a hash of the flux of a single spectrum, the
+    spectral axis, the units, the interpolated precomputed matrix and
+    the solver settings. The cache is stored in an SQLite database and
+    the least-recently-used entries are evicted beyond maxcount.
+
+    Attributes:
+        filename (str): Path to the database.
+        maxcount (int): Maximum number of entries.
+        hits (int): Number of spectra found in the cache.
+        misses (int): Number of spectra not found in the cache.
+        evictions (int): Number of evicted entries.
+    """
+
+    def __init__(self, filename=None, maxcount=1000000):
+        """Construct a cache object.
+
+        Keywords:
+            filename (str): Path to the database (defaults to
+                PYPAHDB_RESULT_CACHE or results.sqlite in the user's
+                cache directory).
+            maxcount (int): Maximum number of entries (defaults to
+                1000000).
+        """
+        if filename is None:
+            filename = os.getenv("PYPAHDB_RESULT_CACHE")
+        if filename is None:
+            filename = os.path.join(
+                os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                "pypahdb",
+                "results.sqlite",
+            )
+        directory = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(directory, exist_ok=True)
+
+        self.filename = filename
+        self.maxcount = maxcount
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False, timeout=60.0)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, weights BLOB, accessed REAL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)"
+            )
+
+    @staticmethod
+    def keys(matrix, pool_shape, abscissa, unit, sigma=None, **settings):
+        """Return the cache key of each spectrum.
+
+        Args:
+            matrix (numpy.ndarray): The interpolated matrix.
+            pool_shape (numpy.ndarray): The spectra as (n_wave, n_spectra).
+            abscissa (quantity.Quantity): The frequency grid.
+            unit (astropy.units.Unit): The flux unit.
+            sigma (numpy.ndarray): Optional, the standard deviation of the
+                spectra for a weighted fit.
+
+        Keywords:
+            settings: The solver settings.
+
+        Returns:
+            list: The hexadecimal key of each spectrum.
+        """
+        common = hashlib.sha256()
+        common.update(np.ascontiguousarray(matrix).tobytes())
+        common.update(np.ascontiguousarray(abscissa.value, dtype=float).tobytes())
+        common.update(f"{abscissa.unit}|{unit}|{sorted(settings.items())}".encode())
+
+        keys = []
+        for i, spectrum in enumerate(np.asarray(pool_shape).T):
+            digest = common.copy()
+            digest.update(str(spectrum.dtype).encode())
+            digest.update(np.ascontiguousarray(spectrum).tobytes())
+            if sigma is not None:
+                digest.update(b"sigma")
+                digest.update(np.ascontiguousarray(sigma[:, i], dtype=float).tobytes())
+            keys.append(digest.hexdigest())
+
+        return keys
+
+    def solve(
+        self,
+        matrix,
+        pool_shape,
+        mask,
+        abscissa,
+        unit,
+        timings=None,
+        chi2=None,
+        sigma=None,
+        ratios=None,
+        variance=None,
+        **settings,
+    ):
+        """Fit the unmasked spectra, reusing cached weights.
+
+        Identical spectra are looked up and fitted only once, and count
+        as a single hit or miss.
+
+        Args:
+            matrix (numpy.ndarray): The interpolated matrix.
+            pool_shape (numpy.ndarray): The spectra as (n_wave, n_spectra).
+            mask (numpy.ndarray): The spectra to fit.
+            abscissa (quantity.Quantity): The frequency grid.
+            unit (astropy.units.Unit): The flux unit.
+            timings (numpy.ndarray): Optional, receives the solve time
+                of each fitted spectrum in seconds.
+            chi2 (numpy.ndarray): Optional, receives the chi-square of
+                each fitted spectrum when weighted.
+            sigma (numpy.ndarray): Optional, the standard deviation of the
+                spectra for a weighted fit.
+            ratios (tuple): Optional, the ratios of the weights to
+                propagate the fit covariance to.
+            variance (numpy.ndarray): Optional, receives the variance of
+                the ratios of each fitted spectrum.
+
+        Keywords:
+            settings: The solver settings, passed on to the solver.
+
+        Returns:
+            numpy.ndarray: The weights as (n_spectra, n_species).
+        """
+        keys = self.keys(matrix, pool_shape, abscissa, unit, sigma=sigma, **settings)
+        index = np.flatnonzero(mask)
+
+        # Look up and fit identical spectra only once.
+        first = {}
+        for i in index:
+            first.setdefault(keys[i], i)
+        cached = self.get(list(first))
+
+        # Only fit the spectra not in the cache.
+        missing = np.zeros_like(mask)
+        for key, i in first.items():
+            missing[i] = key not in cached
+        weights = _decomposer_solve(
+            matrix,
+            pool_shape,
+            missing,
+            timings=timings,
+            chi2=chi2,
+            sigma=sigma,
+            ratios=ratios,
+            variance=variance,
+            **settings,
+        )
+
+        for i in index:
+            key = keys[i]
+            if key in cached:
+                weights[i] = cached[key]
+            elif i != first[key]:
+                weights[i] = weights[first[key]]
+                if chi2 is not None:
+                    chi2[i] = chi2[first[key]]
+                if variance is not None:
+                    variance[i] = variance[first[key]]
+        self.put({keys[i]: weights[i] for i in np.flatnonzero(missing)})
+
+        return weights
+
+    def get(self, keys):
+        """Return the cached weights for keys.
+
+        Args:
+            keys (list): The keys to look up.
+
+        Returns:
+            dict: The weights of each key found.
+        """
+        found = {}
+        with self._lock, self._db:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i: i + 500]
+                rows = self._db.execute(
+                    "SELECT key, weights FROM results WHERE key IN "
+                    f"({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                found.update({k: np.frombuffer(w, dtype=float) for k, w in rows})
+            self._db.executemany(
+                "UPDATE results SET accessed = ? WHERE key = ?",
+                [(time.time(), k) for k in found],
+            )
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        return found
+
+    def put(self, weights):
+        """Store weights, evicting the least-recently-used entries.
+
+        Args:
+            weights (dict): The weights for each key.
+        """
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                [
+                    (k, np.ascontiguousarray(w, dtype=float).tobytes(), time.time())
+                    for k, w in weights.items()
+                ],
+            )
+            count = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            if count > self.maxcount:
+                self._db.execute(
+                    "DELETE FROM results WHERE key IN (SELECT key FROM results "
+                    "ORDER BY accessed LIMIT ?)",
+                    (count - self.maxcount,),
+                )
+                self.evictions += count - self.maxcount
+
+    def stats(self):
+        """Return the cache statistics.
+
+        Returns:
+            dict: The number of hits, misses and evictions, the hit rate
+            and the number of entries.
+        """
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            lookups = self.hits + self.misses
+
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+            }
+
+    def clear(self):
+        """Remove all entries and reset the statistics."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM results")
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self._db.close()
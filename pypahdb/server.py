@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+server.py
+
+Long-running local decomposition service that keeps the precomputed
+and interpolated matrices warm and coalesces concurrent requests into
+batches.
+
+This file is part of pypahdb - see the module docs for more
+information.
+"""
+import argparse
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from astropy import units as u
+from specutils import Spectrum
+
+from pypahdb.decomposer_base import (
+    _decomposer_convert,
+    _decomposer_load,
+    set_thread_budget,
+)
+from pypahdb.decomposer_batch import decompose_batch
+
+
+def _number(value):
+    """Return value as a float, or None when not finite, as JSON has no
+    NaN or infinity."""
+    value = float(value)
+
+    return value if np.isfinite(value) else None
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server listening on a Unix socket."""
+
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Handle the requests to a DecompositionServer."""
+
+    def address_string(self):
+        return str(self.client_address or "unix")
+
+    def log_message(self, format, *args):
+        if self.server.decomposition.verbose:
+            super().log_message(format, *args)
+
+    def _respond(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._respond(200, self.server.decomposition.stats())
+        else:
+            self._respond(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/decompose":
+            self._respond(404, {"error": "not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            spectrum = Spectrum(
+                flux=np.asarray(request["flux"], dtype=float)[None, None, :]
+                * u.Unit(request.get("flux_unit", "MJy/sr")),
+                spectral_axis=np.asarray(request["spectral_axis"], dtype=float)
+                * u.Unit(request.get("spectral_axis_unit", "micron")),
+            )
+            # Reject units that cannot be converted here, rather than
+            # in the batch.
+            _decomposer_convert(spectrum)
+        except (KeyError, TypeError, ValueError, u.UnitsError) as e:
+            self._respond(400, {"error": str(e)})
+            return
+
+        try:
+            result = self.server.decomposition.submit(spectrum)
+        except queue.Full:
+            self._respond(503, {"error": "queue full"}, {"Retry-After": "1"})
+            return
+        except Exception as e:
+            self._respond(500, {"error": str(e)})
+            return
+
+        self._respond(200, result)
+
+
+class DecompositionServer(object):
+    """Serve decompositions of single spectra over HTTP.
+
+    Spectra are posted as JSON to /decompose with the keys
+    'spectral_axis', 'flux' and, optionally, 'spectral_axis_unit'
+    (defaults to 'micron') and 'flux_unit' (defaults to 'MJy/sr'). The
+    response holds the charge and size fractions, the average number of
+    carbon atoms and the fit error, or null where these are undefined,
+    e.g., for an all-zero spectrum. Requests with units that cannot be
+    converted are rejected with status 400; a spectrum failing in a
+    batch only fails its own request. Requests arriving within the batch
+    window are fitted together, sharing one interpolated matrix and one
+    NNLS batch per spectral grid. When the queue is full, requests are
+    rejected with status 503. Statistics are served from /stats.
+
+    Attributes:
+        address: The bound (host, port) or Unix socket path.
+        batch_window (float): Time to wait for more requests in seconds.
+        max_batch (int): Maximum number of spectra in a batch.
+        verbose (bool): Whether to log the requests.
+    """
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 8765),
+        version=None,
+        batch_window=0.01,
+        max_batch=256,
+        queue_depth=1024,
+        max_matrices=8,
+        verbose=False,
+    ):
+        """Construct a server object.
+
+        The precomputed matrix is loaded up front.
+
+        Keywords:
+            address: (host, port) to listen on or the path of a Unix
+                socket (defaults to ("127.0.0.1", 8765)).
+            version (str): The version of the precomputed matrix to use.
+            batch_window (float): Time to wait for more requests in
+                seconds (defaults to 0.01).
+            max_batch (int): Maximum number of spectra in a batch
+                (defaults to 256).
+            queue_depth (int): Maximum number of waiting requests
+                (defaults to 1024).
+            max_matrices (int): Maximum number of interpolated matrices
+                kept, evicting the least recently used (defaults to 8).
+            verbose (bool): Log the requests (defaults to False).
+        """
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.verbose = verbose
+
+        self._version = version
+        self._max_matrices = max_matrices
+        self._matrices = OrderedDict()
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "rejected": 0, "batches": 0, "spectra": 0}
+        self._running = threading.Event()
+        self._closed = False
+        self._closed_lock = threading.Lock()
+
+        # Warm the precomputed matrix.
+        _decomposer_load(version)
+
+        if isinstance(address, (str, os.PathLike)):
+            self._httpd = _UnixHTTPServer(str(address), _Handler)
+        else:
+            self._httpd = ThreadingHTTPServer(address, _Handler)
+            self._httpd.daemon_threads = True
+        self._httpd.decomposition = self
+        self.address = self._httpd.server_address
+
+    def submit(self, spectrum):
+        """Queue a spectrum and wait for its decomposition.
+
+        Args:
+            spectrum (specutils.Spectrum): The spectrum to decompose.
+
+        Returns:
+            dict: The decomposition results.
+
+        Raises:
+            queue.Full: When the queue is full.
+            RuntimeError: When the server is, or was while waiting, shut
+                down.
+        """
+        request = {"spectrum": spectrum, "done": threading.Event()}
+        with self._stats_lock:
+            self._stats["requests"] += 1
+        with self._closed_lock:
+            if self._closed:
+                raise RuntimeError("server is shut down")
+            try:
+                self._queue.put_nowait(request)
+            except queue.Full:
+                with self._stats_lock:
+                    self._stats["rejected"] += 1
+                raise
+
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+
+        return request["result"]
+
+    def stats(self):
+        """Return the service statistics.
+
+        Returns:
+            dict: The number of requests, rejected requests, batches and
+            fitted spectra, the mean batch size and the queue length.
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["mean_batch"] = 0.0
+        if stats["batches"]:
+            stats["mean_batch"] = stats["spectra"] / stats["batches"]
+        stats["queued"] = self._queue.qsize()
+
+        return stats
+
+    def _batch(self):
+        """Collect requests arriving within the batch window."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return [r for r in batch if r is not None]
+
+    def _batcher(self):
+        """Fit the batched requests until stopped."""
+        while self._running.is_set():
+            batch = self._batch()
+            if not batch:
+                continue
+
+            try:
+                results = decompose_batch(
+                    [r["spectrum"] for r in batch],
+                    version=self._version,
+                    matrices=self._matrices,
+                )
+                while len(self._matrices) > self._max_matrices:
+                    self._matrices.popitem(last=False)
+            except Exception as e:
+                results = [e] * len(batch)
+
+            with self._stats_lock:
+                self._stats["batches"] += 1
+                self._stats["spectra"] += len(batch)
+
+            for request, result in zip(batch, results):
+                try:
+                    if isinstance(result, Exception):
+                        raise result
+                    if result is None:
+                        raise ValueError("spectrum could not be fitted")
+                    request["result"] = {
+                        "charge_fractions": {
+                            k: _number(v[0, 0])
+                            for k, v in result.charge_fractions.items()
+                        },
+                        "size_fractions": {
+                            k: _number(v[0, 0]) for k, v in result.size_fractions.items()
+                        },
+                        "nc": _number(result.nc[0, 0]),
+                        "error": _number(result.error[0, 0]),
+                    }
+                except Exception as e:
+                    request["error"] = e
+                request["done"].set()
+
+    def start(self):
+        """Start serving in background threads."""
+        self._running.set()
+        threading.Thread(target=self._batcher, daemon=True).start()
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def serve_forever(self):
+        """Serve until interrupted."""
+        self._running.set()
+        threading.Thread(target=self._batcher, daemon=True).start()
+        try:
+            self._httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """Stop serving.
+
+        Requests still waiting in the queue fail with a RuntimeError.
+        """
+        self._running.clear()
+        with self._closed_lock:
+            self._closed = True
+            while True:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not None:
+                    request["error"] = RuntimeError("server is shut down")
+                    request["done"].set()
+        self._queue.put_nowait(None)
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+def main(argv=None):
+    """Run the pypahdb decomposition server.
+
+    Args:
+        argv (list): Command-line arguments (defaults to sys.argv[1:]).
+
+    Returns:
+        int: The exit status.
+    """
+    parser = argparse.ArgumentParser(
+        prog="pypahdb-server", description="Serve pyPAHdb decompositions."
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="host to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on")
+    parser.add_argument("--socket", help="Unix socket to listen on instead")
+    parser.add_argument(
+        "-m", "--matrix-version", help="version of the precomputed matrix"
+    )
+    parser.add_argument(
+        "--batch-window", type=float, default=0.01, help="batch window [s]"
+    )
+    parser.add_argument("--max-batch", type=int, default=256, help="maximum batch")
+    parser.add_argument(
+        "--queue-depth", type=int, default=1024, help="maximum waiting requests"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="log requests")
+    parser.add_argument(
+        "--processes", type=int, help="fitting processes (defaults to CPUs - 1)"
+    )
+    parser.add_argument(
+        "--blas-threads", type=int, help="BLAS/OpenMP threads per fitting process"
+    )
+    args = parser.parse_args(argv)
+
+    set_thread_budget(args.processes, args.blas_threads)
+    server = DecompositionServer(
+        address=args.socket if args.socket else (args.host, args.port),
+        version=args.matrix_version,
+        batch_window=args.batch_window,
+        max_batch=args.max_batch,
+        queue_depth=args.queue_depth,
+        verbose=args.verbose,
+    )
+    print(f"serving on {server.address}", file=sys.stderr)
+    server.serve_forever()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# test_cli.py
+
+"""
+test_cli.py: unit tests for the command-line interface.
+"""
+
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import importlib_resources
+
+from pypahdb.cli import _outputs, main, run
+
+
+class CliTestCase(unittest.TestCase):
+    """Unit tests for `cli.py`."""
+
+    def setUp(self):
+        file_path = importlib_resources.files("pypahdb") / "resources"
+        self.files = [
+            str(file_path / "sample_data_NGC7023.tbl"),
+            str(file_path / "sample_data_VV114E.tbl"),
+        ]
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_run(self):
+        """Can we decompose several files in a pipeline?"""
+        summary = run(
+            self.files, output_dir=self.tmpdir.name, version="3.20", workers=2
+        )
+
+        assert [s["file"] for s in summary] == self.files
+        for s in summary:
+            assert s["error"] is None
+            assert s["fit"] is not None
+        assert os.path.isfile(
+            os.path.join(self.tmpdir.name, "sample_data_VV114E_pypahdb.fits")
+        )
+
+    def test_pool_before_threads(self):
+        """Is the process pool started before the pipeline threads?"""
+        counts = []
+        before = threading.active_count()
+        with mock.patch(
+            "pypahdb.cli._decomposer_pool",
+            side_effect=lambda: counts.append(threading.active_count()),
+        ):
+            run(self.files[:1], output_dir=self.tmpdir.name, version="3.20")
+
+        assert counts == [before]
+
+    def test_outputs(self):
+        """Do files sharing a name get distinct outputs?"""
+        files = [
+            os.path.join("a", "obs.fits"),
+            os.path.join("b", "obs.fits"),
+            os.path.join("b", "obs.tbl"),
+            os.path.join("b", "other.fits"),
+        ]
+        outputs = _outputs(files, self.tmpdir.name)
+        assert len(set(outputs.values())) == len(files)
+        assert outputs[files[0]] == os.path.join(self.tmpdir.name, "a_obs_fits_pypahdb")
+        assert outputs[files[1]] == os.path.join(self.tmpdir.name, "b_obs_fits_pypahdb")
+        assert outputs[files[2]] == os.path.join(self.tmpdir.name, "obs_tbl_pypahdb")
+        assert outputs[files[3]] == os.path.join(self.tmpdir.name, "other_pypahdb")
+
+        # Next to their input, files in different directories do not collide.
+        outputs = _outputs(files[:2])
+        assert outputs[files[0]] == os.path.join("a", "obs_pypahdb")
+
+        files = [os.path.join("x", "a", "obs.fits"), os.path.join("y", "a", "obs.fits")]
+        self.assertRaises(ValueError, _outputs, files, self.tmpdir.name)
+
+    def test_failure(self):
+        """Are failures reported in the summary and exit status?"""
+        argv = ["file_does_not_exist.tbl", "-o", self.tmpdir.name, "-m", "3.20"]
+
+        assert main(argv) == 1
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,6 +15,9 @@ from astropy import units as u
 
 from pypahdb.observation import Observation
 from pypahdb.decomposer import Decomposer
+from pypahdb import decomposer_base
+from pypahdb.decomposer_base import PrecomputedCache
+from pypahdb.picker import Picker
 
 
 class DecomposerTestCase(unittest.TestCase):
@@ -28,6 +31,9 @@ class DecomposerTestCase(unittest.TestCase):
         file_path = importlib_resources.files("pypahdb") / file_name
         self.observation = Observation(file_path)
         self.decomposer = Decomposer(self.observation.spectrum, version="3.20")
+        file_name = "resources/sample_data_NGC7023.fits"
+        file_path = importlib_resources.files("pypahdb") / file_name
+        self.cube = Observation(file_path).spectrum
         self.tmpdir = tempfile.gettempdir()
 
     def test_is_instance(self):
@@ -70,6 +76,306 @@ class DecomposerTestCase(unittest.TestCase):
         self.decomposer.save_fits(ofile)
         assert os.path.isfile(ofile)
 
+    def test_state(self):
+        """Can we save and reload the decomposition without refitting?"""
+        ofile = os.path.join(self.tmpdir, "result.npz")
+        self.decomposer.save_state(ofile)
+        decomposer = Decomposer.load_state(ofile)
+        assert isinstance(decomposer, Decomposer)
+        assert np.allclose(decomposer.nc, self.decomposer.nc, rtol=1e-5)
+        assert np.allclose(decomposer.fit, self.decomposer.fit, rtol=1e-5)
+        for key, value in self.decomposer.size_fractions.items():
+            assert np.allclose(decomposer.size_fractions[key], value, rtol=1e-5)
+
+        # Without the spectrum, which then needs to be passed back.
+        compact = os.path.join(self.tmpdir, "compact.npz")
+        self.decomposer.save_state(compact, spectrum=False)
+        assert os.path.getsize(compact) < os.path.getsize(ofile)
+        self.assertRaises(ValueError, Decomposer.load_state, compact)
+        decomposer = Decomposer.load_state(compact, spectrum=self.decomposer.spectrum)
+        assert np.allclose(decomposer.error, self.decomposer.error, rtol=1e-5)
+
+    def test_update(self):
+        """Can we refit only the changed pixels?"""
+        from specutils import Spectrum
+
+        spectrum = self.cube
+        decomposer = Decomposer(spectrum, version="3.20")
+        decomposer.fit
+        decomposer.nc
+
+        flux = spectrum.flux.copy()
+        flux[2, 3, :] *= 1.5
+        updated = Spectrum(flux=flux, spectral_axis=spectrum.spectral_axis)
+        changed = decomposer.update(updated)
+        assert np.sum(changed) == 1 and changed[3, 2]
+
+        expected = Decomposer(updated, version="3.20")
+        assert np.allclose(decomposer._weights, expected._weights)
+        assert np.allclose(decomposer.fit, expected.fit)
+        assert np.allclose(decomposer.nc, expected.nc)
+
+    def test_solve_time(self):
+        """Do we record the solve time of each fitted pixel?"""
+        from scipy.optimize import nnls
+
+        spectrum = self.cube
+        decomposer = Decomposer(spectrum, version="3.20")
+        solve_time = decomposer.solve_time
+        assert solve_time.unit == u.s
+        assert solve_time.shape == decomposer.mask.shape
+        assert np.all(solve_time[decomposer.mask] > 0)
+        assert np.all(solve_time[~decomposer.mask] == 0)
+
+        # Results collected out of order land on their own pixel.
+        j, i = np.argwhere(decomposer.mask)[-1]
+        m = decomposer._matrix / decomposer._matrix.max()
+        y = spectrum.flux.value.T[:, j, i]
+        x, _ = nnls(m, y / y.max())
+        weights = x / (decomposer._matrix.max() / y.max())
+        assert np.allclose(decomposer._weights[:, j, i], weights)
+
+    def test_shared(self):
+        """Is the matrix shared with the workers once, not per task?"""
+        import gc
+        import pickle
+        from functools import partial
+
+        decomposer = Decomposer(self.observation.spectrum, version="3.20")
+        m = decomposer._matrix / decomposer._matrix.max()
+        path = decomposer_base._decomposer_share(decomposer._matrix, m)
+        assert decomposer_base._decomposer_share(decomposer._matrix, m) == path
+        assert np.array_equal(np.load(path), m)
+
+        task = partial(decomposer_base._decomposer_nnls_block, m=path)
+        assert len(pickle.dumps(task)) < m.nbytes // 10
+
+        del decomposer
+        gc.collect()
+        assert not os.path.exists(path)
+
+    def test_float32(self):
+        """Does single precision agree with double precision?"""
+        decomposer = Decomposer(
+            self.observation.spectrum, version="3.20", dtype=np.float32
+        )
+        assert decomposer._matrix.dtype == np.float32
+        assert decomposer._weights.dtype == np.float32
+        assert decomposer.fit.dtype == np.float32
+        assert decomposer.charge["cation"].dtype == np.float32
+        assert np.allclose(decomposer.fit, self.decomposer.fit, rtol=1e-5)
+        assert np.allclose(decomposer.nc, self.decomposer.nc, rtol=1e-5)
+        for key, value in self.decomposer.charge_fractions.items():
+            assert np.allclose(decomposer.charge_fractions[key], value, atol=1e-6)
+
+        ofile = os.path.join(self.tmpdir, "result32.npz")
+        decomposer.save_state(ofile)
+        assert Decomposer.load_state(ofile)._matrix.dtype == np.float32
+
+    def test_nan(self):
+        """Are non-finite channels left out of the fit?"""
+        from scipy.optimize import nnls
+        from specutils import Spectrum
+
+        spectrum = self.cube
+        flux = spectrum.flux.copy()
+        flux[0, 0, :] = np.nan
+        flux[1, 2, 10:20] = np.nan
+        flux[2, 2, 10:20] = np.nan
+        flux[3, 2, -1] = np.inf
+        decomposer = Decomposer(
+            Spectrum(flux=flux, spectral_axis=spectrum.spectral_axis),
+            version="3.20",
+        )
+        assert not decomposer.mask[0, 0]
+        assert np.all(decomposer._weights[:, 0, 0] == 0)
+        assert np.all(np.isfinite(decomposer._weights))
+        assert np.all(np.isfinite(decomposer.error[decomposer.mask]))
+
+        for i, j in ((1, 2), (2, 2), (3, 2)):
+            assert decomposer.mask[j, i]
+            y = flux.value[i, j, :]
+            valid = np.isfinite(y)
+            m = decomposer._matrix[valid] / decomposer._matrix.max()
+            x, _ = nnls(m, y[valid] / y[valid].max())
+            weights = x / (decomposer._matrix.max() / y[valid].max())
+            assert np.allclose(decomposer._weights[:, j, i], weights)
+
+    def test_weighted(self):
+        """Do we weight the fit by the uncertainty?"""
+        from scipy.optimize import nnls
+        from astropy.nddata import StdDevUncertainty
+        from specutils import Spectrum
+
+        spectrum = self.cube
+        flux = spectrum.flux.value
+
+        # Pixels in the first row share their uncertainty profile.
+        rng = np.random.default_rng(0)
+        sigma = 0.05 * np.abs(flux) + rng.uniform(0.1, 1.0, flux.shape)
+        sigma[:, 0, :] = np.arange(1, flux.shape[0] + 1)[:, None] * np.linspace(
+            0.1, 1.0, flux.shape[2]
+        )
+        spectrum = Spectrum(
+            flux=spectrum.flux,
+            spectral_axis=spectrum.spectral_axis,
+            uncertainty=StdDevUncertainty(sigma * spectrum.flux.unit),
+        )
+        decomposer = Decomposer(spectrum, version="3.20", weighted=True)
+        assert np.all(np.isfinite(decomposer.chi2[decomposer.mask]))
+        assert np.all(np.isnan(self.decomposer.chi2))
+
+        for i, j in ((0, 0), (flux.shape[0] - 1, 0), (2, 3)):
+            if not decomposer.mask[j, i]:
+                continue
+            w = 1.0 / sigma[i, j, :]
+            x, rnorm = nnls(decomposer._matrix * w[:, None], flux[i, j, :] * w)
+            assert np.allclose(decomposer._weights[:, j, i], x, rtol=1e-4, atol=1e-12)
+            assert np.isclose(decomposer.chi2[j, i], rnorm**2, rtol=1e-4)
+
+    def test_qr(self):
+        """Does the QR-projected solver agree with the full problem?"""
+        import gc
+        from astropy.nddata import StdDevUncertainty
+        from specutils import Spectrum
+
+        spectrum = self.cube
+        flux = spectrum.flux.copy()
+        flux[1, 2, 10:20] = np.nan
+        spectrum = Spectrum(
+            flux=flux,
+            spectral_axis=spectrum.spectral_axis,
+            uncertainty=StdDevUncertainty(0.05 * np.abs(flux) + 1.0 * flux.unit),
+        )
+        for weighted in (False, True):
+            full = Decomposer(spectrum, version="3.20", weighted=weighted)
+            qr = Decomposer(spectrum, version="3.20", weighted=weighted, solver="qr")
+            assert np.allclose(qr._weights, full._weights, rtol=1e-6, atol=1e-12)
+            assert np.allclose(qr.chi2, full.chi2, rtol=1e-6, equal_nan=True)
+
+        # The factorization lives as long as the interpolated matrix.
+        qr = Decomposer(spectrum, version="3.20", solver="qr")
+        key = (id(qr._matrix), "qr")
+        assert key in decomposer_base._derived
+        m = qr._matrix / qr._matrix.max()
+        factorization = decomposer_base._decomposer_qr(qr._matrix, m)
+        assert decomposer_base._decomposer_qr(qr._matrix, m) is factorization
+        del qr, factorization
+        gc.collect()
+        assert key not in decomposer_base._derived
+
+        with self.assertRaises(ValueError):
+            Decomposer(self.observation.spectrum, version="3.20", solver="lsq")
+
+    def test_pg(self):
+        """Does the projected-gradient solver converge to the NNLS?"""
+        spectrum = self.cube
+        full = Decomposer(spectrum, version="3.20")
+        polished = Decomposer(spectrum, version="3.20", solver="pg")
+        assert np.allclose(polished._weights, full._weights, rtol=1e-6, atol=1e-12)
+
+        decomposer = Decomposer(
+            spectrum,
+            version="3.20",
+            solver="pg",
+            solver_options={"tol": 1e-8, "max_iter": 20000, "polish": False},
+        )
+        mask = full.mask
+        assert np.allclose(decomposer.error[mask], full.error[mask], rtol=1e-6)
+        assert np.allclose(decomposer.nc[mask], full.nc[mask], rtol=1e-3)
+
+        ofile = os.path.join(self.tmpdir, "result_pg.npz")
+        decomposer.save_state(ofile)
+        assert Decomposer.load_state(ofile)._settings == decomposer._settings
+
+    def test_reduced(self):
+        """Do we fit with representatives of near-collinear species?"""
+        spectrum = self.cube
+        full = Decomposer(spectrum, version="3.20")
+        mask = full.mask
+
+        # Without clusters, the fit is the NNLS.
+        decomposer = Decomposer(
+            spectrum,
+            version="3.20",
+            solver="reduced",
+            solver_options={"similarity": 1.0},
+        )
+        assert np.allclose(decomposer._weights, full._weights)
+
+        m = full._matrix / full._matrix.max()
+        labels, representatives = decomposer_base._decomposer_basis(full._matrix, m, 0.5)
+        assert len(representatives) < m.shape[1]
+        assert np.array_equal(labels[representatives], np.arange(len(representatives)))
+
+        errors = []
+        for refit in (True, False):
+            decomposer = Decomposer(
+                spectrum,
+                version="3.20",
+                solver="reduced",
+                solver_options={"similarity": 0.5, "refit": refit},
+            )
+            assert np.all(decomposer._weights >= 0)
+            total = sum(decomposer.charge_fractions.values())
+            assert np.allclose(total[mask], 1.0)
+            errors.append(decomposer.error[mask])
+        assert np.all(errors[0] >= full.error[mask] - 1e-10)
+        assert np.all(errors[1] >= errors[0] - 1e-10)
+
+    def test_uncertainties(self):
+        """Do we propagate the fit covariance to the fractions?"""
+        decomposer = Decomposer(
+            self.observation.spectrum, version="3.20", uncertainties=True
+        )
+        for key, value in decomposer.charge_fractions_uncertainty.items():
+            assert np.all(np.isfinite(value[decomposer.mask]))
+        for key, value in decomposer.size_fractions_uncertainty.items():
+            assert np.all(value[decomposer.mask] >= 0)
+        assert decomposer.nc_uncertainty.shape == decomposer.nc.shape
+        assert np.all(np.isnan(self.decomposer.nc_uncertainty))
+
+    def test_variance(self):
+        """Does the propagated variance match resampling?"""
+        from scipy.optimize import nnls
+
+        rng = np.random.default_rng(0)
+        a = rng.uniform(0.0, 1.0, (50, 3))
+        y = a @ np.array([1.0, 2.0, 3.0])
+        ratios = (np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 1.0]]), np.ones(3))
+
+        x, rnorm = nnls(a, y + rng.normal(0.0, 0.01, y.shape))
+        variance = decomposer_base._decomposer_variance(a, x, rnorm, ratios)
+
+        q = []
+        for _ in range(2000):
+            x, _ = nnls(a, y + rng.normal(0.0, 0.01, y.shape))
+            q.append(ratios[0] @ x / np.sum(x))
+        assert np.allclose(np.sqrt(variance), np.std(q, axis=0), rtol=0.2)
+
+    def test_monte_carlo(self):
+        """Do we estimate uncertainties by resampling?"""
+        import importlib_resources
+
+        file_name = "resources/sample_data_VV114E.tbl"
+        file_path = importlib_resources.files("pypahdb") / file_name
+        decomposer = Decomposer(Observation(file_path).spectrum, version="3.20")
+
+        results = decomposer.monte_carlo(n=20, seed=1)
+        assert results["realizations"] == 20
+        assert results["nc"].shape == (3,) + decomposer.nc.shape
+        low, median, high = results["charge_fractions"]["cation"]
+        assert np.all(low <= median) and np.all(median <= high)
+        assert set(results["size_fractions"]) == {"large", "medium", "small"}
+
+        again = decomposer.monte_carlo(n=20, seed=1)
+        assert np.array_equal(again["nc"], results["nc"])
+
+        results = decomposer.monte_carlo(n=100000, time_budget=0.5)
+        assert 0 < results["realizations"] < 100000
+
+        self.assertRaises(ValueError, self.decomposer.monte_carlo)
+
     def test_plot_map(self):
         assert isinstance(
             Decomposer.plot_map(
@@ -79,5 +385,59 @@ class DecomposerTestCase(unittest.TestCase):
         )
 
 
+class PrecomputedCacheTestCase(unittest.TestCase):
+    """Unit tests for `PrecomputedCache`."""
+
+    def test_cache_hit(self):
+        """Is a loaded matrix reused?"""
+        cache = PrecomputedCache()
+        path = Picker().pick("3.20")
+        assert cache.get(path) is cache.get(path)
+
+    def test_cache_evict(self):
+        """Are the least-recently-used matrices evicted?"""
+        cache = PrecomputedCache(maxcount=0)
+        path = Picker().pick("3.20")
+        assert cache.get(path) is not cache.get(path)
+
+
+class ThreadBudgetTestCase(unittest.TestCase):
+    """Unit tests for the thread budget of the shared pool."""
+
+    def tearDown(self):
+        decomposer_base.set_thread_budget()
+
+    def test_default(self):
+        """Do the defaults not oversubscribe the CPUs?"""
+        processes, threads = decomposer_base.thread_budget()
+        cpus = decomposer_base._cpu_count()
+        assert processes >= 1 and threads >= 1
+        assert processes * threads <= cpus
+
+    def test_override(self):
+        """Are the pool processes limited to the budget?"""
+        decomposer_base.set_thread_budget(processes=2, threads=3)
+        assert decomposer_base.thread_budget() == (2, 3)
+        pool = decomposer_base._decomposer_pool()
+        assert pool._processes == 2
+        assert pool.apply(os.getenv, ("OPENBLAS_NUM_THREADS",)) == "3"
+
+        self.assertRaises(ValueError, decomposer_base.set_thread_budget, 0)
+
+    def test_environment(self):
+        """Are empty variables unset and invalid ones rejected?"""
+        from unittest import mock
+
+        default = decomposer_base.thread_budget()
+        with mock.patch.dict(os.environ, {"PYPAHDB_PROCESSES": ""}):
+            assert decomposer_base.thread_budget() == default
+        with mock.patch.dict(os.environ, {"PYPAHDB_PROCESSES": "2"}):
+            assert decomposer_base.thread_budget()[0] == 2
+        for value in ("0", "-1", "two"):
+            with mock.patch.dict(os.environ, {"PYPAHDB_BLAS_THREADS": value}):
+                with self.assertRaisesRegex(ValueError, "PYPAHDB_BLAS_THREADS"):
+                    decomposer_base.thread_budget()
+
+
 if __name__ == "__main__":
     unittest.main()
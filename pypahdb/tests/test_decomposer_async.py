@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# test_decomposer_async.py
+
+"""
+test_decomposer_async.py: unit tests for the asyncio entry points.
+"""
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from pypahdb import decomposer_async
+from pypahdb.decomposer import Decomposer
+from pypahdb.observation import Observation
+
+
+class DecomposerAsyncTestCase(unittest.TestCase):
+    """Unit tests for `decomposer_async.py`."""
+
+    def setUp(self):
+        import importlib_resources
+
+        file_path = importlib_resources.files("pypahdb") / "resources"
+        self.spectra = [
+            Observation(file_path / "sample_data_NGC7023.tbl").spectrum,
+            Observation(file_path / "sample_data_VV114E.tbl").spectrum,
+        ]
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_concurrent(self):
+        """Can many decompositions be in flight concurrently?"""
+
+        async def _main():
+            decomposers = await asyncio.gather(
+                *[
+                    decomposer_async.decompose(s, version="3.20")
+                    for s in self.spectra
+                ]
+            )
+            values = await asyncio.gather(
+                *[decomposer_async.compute(d, "fit", "nc") for d in decomposers]
+            )
+            await asyncio.gather(
+                *[
+                    decomposer_async.save_fits(
+                        d, os.path.join(self.tmpdir.name, f"{i}.fits")
+                    )
+                    for i, d in enumerate(decomposers)
+                ]
+            )
+            return decomposers, values
+
+        decomposers, values = asyncio.run(_main())
+
+        for spectrum, decomposer, value in zip(self.spectra, decomposers, values):
+            assert isinstance(decomposer, Decomposer)
+            expected = Decomposer(spectrum, version="3.20")
+            assert np.allclose(value["nc"], expected.nc)
+            assert np.allclose(value["fit"], expected.fit)
+        assert os.path.isfile(os.path.join(self.tmpdir.name, "1.fits"))
+
+    def test_cancel(self):
+        """Can a decomposition be cancelled?"""
+
+        async def _main():
+            task = asyncio.create_task(
+                decomposer_async.decompose(self.spectra[0], version="3.20")
+            )
+            await asyncio.sleep(0)
+            task.cancel()
+            await task
+
+        self.assertRaises(asyncio.CancelledError, asyncio.run, _main())
+
+
+if __name__ == "__main__":
+    unittest.main()
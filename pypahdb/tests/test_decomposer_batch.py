@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# test_decomposer_batch.py
+
+"""
+test_decomposer_batch.py: unit tests for decompose_batch.
+"""
+
+import unittest
+import numpy as np
+
+from pypahdb.observation import Observation
+from pypahdb.decomposer import Decomposer
+from pypahdb.decomposer_batch import DecomposerResult, decompose_batch
+
+
+class DecomposerBatchTestCase(unittest.TestCase):
+    """Unit tests for `decomposer_batch.py`."""
+
+    def setUp(self):
+        import importlib_resources
+
+        file_path = importlib_resources.files("pypahdb") / "resources"
+        self.spectra = [
+            Observation(file_path / "sample_data_NGC7023.tbl").spectrum,
+            Observation(file_path / "sample_data_VV114E.tbl").spectrum,
+            Observation(file_path / "sample_data_NGC7023.tbl").spectrum,
+        ]
+        self.results = decompose_batch(self.spectra, version="3.20")
+
+    def test_is_instance(self):
+        """Do we get a DecomposerResult for each spectrum?"""
+        assert len(self.results) == len(self.spectra)
+        for result in self.results:
+            assert isinstance(result, DecomposerResult)
+
+    def test_shares_matrix(self):
+        """Do spectra on the same grid share the interpolated matrix?"""
+        assert self.results[0]._matrix is self.results[2]._matrix
+        assert self.results[0]._matrix is not self.results[1]._matrix
+
+    def test_matches_decomposer(self):
+        """Are the results the same as from Decomposer?"""
+        for spectrum, result in zip(self.spectra, self.results):
+            decomposer = Decomposer(spectrum, version="3.20")
+            assert np.allclose(result.fit, decomposer.fit)
+            assert np.allclose(result.nc, decomposer.nc)
+            for key, value in decomposer.charge_fractions.items():
+                assert np.allclose(result.charge_fractions[key], value)
+
+    def test_failure(self):
+        """Does a spectrum that cannot be converted leave the others be?"""
+        import astropy.units as u
+        from specutils import Spectrum
+
+        spectrum = self.spectra[0]
+        bad = Spectrum(flux=spectrum.flux.value * u.m, spectral_axis=spectrum.spectral_axis)
+        results = decompose_batch([spectrum, bad, spectrum], version="3.20")
+
+        assert results[1] is None
+        for result in (results[0], results[2]):
+            assert np.allclose(result.fit, self.results[0].fit)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# test_import.py
+
+"""
+test_import.py: lazy imports and import-time budget of pypahdb.
+"""
+
+import subprocess
+import sys
+import unittest
+
+# Dependencies that pypahdb.decomposer needs to import.
+BASELINE_MODULES = ["numpy", "astropy.units", "astropy.io.fits"]
+
+# Maximum time to import pypahdb.decomposer after its dependencies,
+# relative to the time to import those dependencies.
+IMPORT_BUDGET = 1.0
+
+# Modules that must only be imported on first use.
+LAZY_MODULES = [
+    "matplotlib",
+    "mpl_toolkits",
+    "astropy.wcs",
+    "scipy.optimize",
+    "specutils",
+    "tqdm",
+    "pypahdb._version",
+]
+
+
+class ImportTestCase(unittest.TestCase):
+    """Lazy imports and import-time budget of `decomposer.py`."""
+
+    def setUp(self):
+        code = (
+            "import sys, time\n"
+            "t = time.perf_counter()\n"
+            f"import {', '.join(BASELINE_MODULES)}\n"
+            "print(time.perf_counter() - t)\n"
+            "t = time.perf_counter()\n"
+            "import pypahdb.decomposer\n"
+            "print(time.perf_counter() - t)\n"
+            f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))\n"
+        )
+        out = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        ).stdout.splitlines()
+        self.baseline = float(out[0])
+        self.elapsed = float(out[1])
+        self.loaded = out[2]
+
+    def test_lazy_modules(self):
+        """Are the plotting and fitting modules imported lazily?"""
+        assert self.loaded == ""
+
+    def test_import_budget(self):
+        """Does importing pypahdb.decomposer stay within budget?
+
+        The budget is relative to importing its dependencies in the same
+        interpreter, so that it holds on slower machines too.
+        """
+        assert self.elapsed < IMPORT_BUDGET * self.baseline, (
+            f"import pypahdb.decomposer took {self.elapsed:.3f} s, "
+            f"its dependencies {self.baseline:.3f} s"
+        )
+
+    def test_version(self):
+        """Is the version still available?"""
+        import pypahdb
+
+        assert isinstance(pypahdb.__version__, str)
+
+
+if __name__ == "__main__":
+    unittest.main()
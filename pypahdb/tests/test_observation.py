@@ -5,10 +5,16 @@
 test_observation.py: unit tests for class observation.
 """
 
+import os
+import tempfile
 import unittest
 import importlib_resources
 
-from pypahdb.observation import Observation
+import numpy as np
+from astropy.io import fits
+from astropy.nddata import StdDevUncertainty
+
+from pypahdb.observation import DO_NOT_USE, Observation
 
 
 class SpectrumTestCase(unittest.TestCase):
@@ -48,6 +54,35 @@ class SpectrumTestCase(unittest.TestCase):
 
         self.assertRaises(OSError, Observation, file_path)
 
+    def test_read_dq_err(self):
+        """Do we mask DQ flagged samples and carry ERR for cubes?"""
+        sci = np.random.default_rng(0).uniform(1, 2, (200, 3, 4))
+        dq = np.zeros(sci.shape, dtype=np.uint32)
+        dq[:, 0, 0] = DO_NOT_USE
+        dq[50:60, 1, 1] = DO_NOT_USE | 512
+        dq[70, 2, 3] = 4
+        header = fits.Header(
+            {'CRVAL3': 5.0, 'CDELT3': 0.05, 'CUNIT3': 'um', 'BUNIT': 'MJy/sr'}
+        )
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file_path = os.path.join(tmpdir, 'cube.fits')
+            fits.HDUList([
+                fits.PrimaryHDU(),
+                fits.ImageHDU(sci, header=header, name='SCI'),
+                fits.ImageHDU(0.1 * sci, name='ERR'),
+                fits.ImageHDU(dq, name='DQ'),
+            ]).writeto(file_path)
+            spectrum = Observation(file_path).spectrum
+
+        flux = spectrum.flux.value
+        assert isinstance(spectrum.uncertainty, StdDevUncertainty)
+        assert np.allclose(spectrum.uncertainty.array, 0.1 * sci.T)
+        assert np.all(np.isnan(flux[0, 0, :]))
+        assert np.all(np.isnan(flux[1, 1, 50:60]))
+        assert np.isfinite(flux[3, 2, 70])
+        assert np.sum(np.isnan(flux)) == np.sum(spectrum.mask) == 210
+
 
 if __name__ == '__main__':
     unittest.main()
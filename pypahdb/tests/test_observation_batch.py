@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# test_observation_batch.py
+
+"""
+test_observation_batch.py: unit tests for class observation_batch.
+"""
+
+import unittest
+import importlib_resources
+
+from pypahdb.observation import Observation
+from pypahdb.observation_batch import ObservationBatch
+
+
+class ObservationBatchTestCase(unittest.TestCase):
+    """Unit tests for `observation_batch.py`."""
+
+    def setUp(self):
+        file_path = importlib_resources.files('pypahdb') / 'resources'
+        self.files = [
+            file_path / 'sample_data_NGC7023.tbl',
+            file_path / 'sample_data_VV114E.tbl',
+            file_path / 'sample_data_NGC7023.tbl',
+            file_path / 'file_does_not_exist.tbl',
+        ]
+
+    def test_is_instance(self):
+        """Can we create an instance of ObservationBatch?"""
+        assert isinstance(ObservationBatch(self.files), ObservationBatch)
+
+    def test_group_by_grid(self):
+        """Are spectra on identical grids stacked together?"""
+        batch = ObservationBatch(self.files, workers=2)
+
+        assert len(batch) == 3
+        assert len(batch.spectra) == 2
+        assert batch.spectra[0].flux.shape[:2] == (2, 1)
+        assert batch.locate(2) == (0, slice(1, 2))
+
+    def test_index_maps_back(self):
+        """Can results be mapped back to their source file?"""
+        batch = ObservationBatch(self.files, processes=True)
+        group, rows = batch.locate(1)
+        obs = Observation(self.files[1])
+
+        assert (
+            batch.spectra[group].flux[rows] == obs.spectrum.flux
+        ).all()
+        assert batch.unstack(1, batch.spectra[group].flux.T).shape == (
+            obs.spectrum.flux.T.shape
+        )
+
+    def test_failures(self):
+        """Are unreadable files reported?"""
+        batch = ObservationBatch(self.files)
+
+        assert isinstance(
+            batch.failures[self.files[3]], FileNotFoundError
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
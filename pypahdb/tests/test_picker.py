@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# test_picker.py
+
+"""
+test_picker.py: unit tests for class picker.
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from pypahdb.picker import RELEASES_TTL, Picker
+
+
+class _CountingHandler(SimpleHTTPRequestHandler):
+    """Serve files and count the requests per path."""
+
+    counts = {}
+    stall = None
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        self.counts[path] = self.counts.get(path, 0) + 1
+        if path == self.stall:
+            time.sleep(1.0)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PickerTestCase(unittest.TestCase):
+    """Unit tests for `picker.py`."""
+
+    def setUp(self):
+        self.pkl_file = Picker().pick("3.20")
+
+    def test_versions(self):
+        """Can we list the downloaded versions?"""
+        assert "3.20" in Picker().versions()
+
+    def test_index(self):
+        """Can we query the metadata without loading the matrix?"""
+        index = Picker().index("3.20")
+
+        assert index["file"] == self.pkl_file.name
+        assert len(index["shape"]) == 2
+        assert "charge" in index["properties"]
+        assert os.path.isfile(self.pkl_file.with_suffix(".json"))
+
+    def test_index_not_available(self):
+        """Do we get None for a matrix that is not available?"""
+        assert Picker().index("0.00") is None
+
+    def test_index_regenerated(self):
+        """Is the metadata regenerated when the pickle changes?"""
+        with tempfile.TemporaryDirectory() as store:
+            pkl_file = shutil.copy2(self.pkl_file, store)
+            picker = Picker(search_paths=[store], store=store)
+            index = picker.index("3.20")
+            assert os.path.dirname(picker.pick("3.20")) == store
+            os.utime(pkl_file, ns=(index["mtime"] + 1, index["mtime"] + 1))
+            assert picker.index("3.20")["mtime"] == index["mtime"] + 1
+
+    def test_environment(self):
+        """Do empty variables count as unset and invalid ones raise?"""
+        with mock.patch.dict(
+            os.environ, {"PYPAHDB_MATRIX_STORE": "", "PYPAHDB_RELEASES_TTL": ""}
+        ):
+            picker = Picker()
+            assert picker._store != pathlib.Path(".")
+            assert picker._releases_ttl == RELEASES_TTL
+
+        for value in ("-1", "day", "nan"):
+            with mock.patch.dict(os.environ, {"PYPAHDB_RELEASES_TTL": value}):
+                with self.assertRaisesRegex(ValueError, "PYPAHDB_RELEASES_TTL"):
+                    Picker()
+
+
+class PickerDownloadTestCase(unittest.TestCase):
+    """Unit tests for downloading with `picker.py`."""
+
+    def setUp(self):
+        self.served = tempfile.TemporaryDirectory()
+        self.resources = tempfile.TemporaryDirectory()
+        self.payload = os.urandom(1 << 20)
+
+        with open(os.path.join(self.served.name, "precomputed_v9.99.pkl"), "wb") as f:
+            f.write(self.payload)
+
+        _CountingHandler.counts = {}
+        _CountingHandler.stall = None
+        self.server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), partial(_CountingHandler, directory=self.served.name)
+        )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.served.cleanup()
+        self.resources.cleanup()
+
+    def _release(self, sha256):
+        releases = [
+            {
+                "version": "9.99",
+                "description": "test",
+                "size": "1M",
+                "location": f"{self.url}/precomputed_v9.99.pkl?version=9.99",
+                "sha256": sha256,
+            }
+        ]
+        with open(os.path.join(self.served.name, "releases.json"), "w") as f:
+            json.dump(releases, f)
+
+    def _pick(self, results):
+        picker = Picker(search_paths=[], store=self.resources.name)
+        with mock.patch("pypahdb.picker.RELEASES_URL", f"{self.url}/releases.json"):
+            try:
+                results.append(picker.pick("9.99"))
+            except OSError as e:
+                results.append(e)
+
+    def test_concurrent_download(self):
+        """Do concurrent requesters share a single download?"""
+        self._release(hashlib.sha256(self.payload).hexdigest())
+
+        results = []
+        threads = [
+            threading.Thread(target=self._pick, args=(results,)) for _ in range(8)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(set(results)) == 1
+        assert _CountingHandler.counts["/precomputed_v9.99.pkl"] == 1
+        with open(results[0], "rb") as f:
+            assert f.read() == self.payload
+
+    def test_checksum_mismatch(self):
+        """Is a corrupt download rejected without leaving a file?"""
+        self._release(hashlib.sha256(b"").hexdigest())
+
+        results = []
+        self._pick(results)
+
+        assert isinstance(results[0], OSError)
+        assert "precomputed_v9.99.pkl" not in os.listdir(self.resources.name)
+        assert not [f for f in os.listdir(self.resources.name) if f.endswith(".part")]
+
+    def test_releases_cached(self):
+        """Is releases.json reused within its TTL?"""
+        self._release(None)
+
+        with mock.patch("pypahdb.picker.RELEASES_URL", f"{self.url}/releases.json"):
+            for _ in range(2):
+                picker = Picker(search_paths=[], store=self.resources.name)
+                assert picker._releases_load()[0]["version"] == "9.99"
+
+        assert _CountingHandler.counts["/releases.json"] == 1
+
+    def test_offline(self):
+        """Does offline mode never touch the network?"""
+        picker = Picker(search_paths=[], store=self.resources.name, offline=True)
+
+        self.assertRaises(FileNotFoundError, picker.pick, "9.99")
+        assert not _CountingHandler.counts
+
+    def test_offline_unknown_version(self):
+        """Does offline mode raise for a version not in the cached releases?"""
+        self._release(None)
+        shutil.copy2(os.path.join(self.served.name, "releases.json"), self.resources.name)
+        picker = Picker(search_paths=[], store=self.resources.name, offline=True)
+
+        with mock.patch("builtins.input", side_effect=AssertionError):
+            self.assertRaises(FileNotFoundError, picker.pick, "0.00")
+
+    def test_timeout(self):
+        """Is a stale releases.json used when the server stalls?"""
+        self._release(None)
+        json_file = shutil.copy2(
+            os.path.join(self.served.name, "releases.json"), self.resources.name
+        )
+        os.utime(json_file, (0, 0))
+        _CountingHandler.stall = "/releases.json"
+
+        picker = Picker(search_paths=[], store=self.resources.name, timeout=0.1)
+        with mock.patch("pypahdb.picker.RELEASES_URL", f"{self.url}/releases.json"):
+            start = time.perf_counter()
+            assert picker._releases_load()[0]["version"] == "9.99"
+            assert time.perf_counter() - start < 1.0
+
+        assert _CountingHandler.counts["/releases.json"] == 1
+
+    def test_search_paths(self):
+        """Are matrices found in the search paths?"""
+        picker = Picker(
+            search_paths=[self.served.name], store=self.resources.name, offline=True
+        )
+
+        assert picker.pick("9.99") == (
+            picker._search_paths[0] / "precomputed_v9.99.pkl"
+        )
+        assert not _CountingHandler.counts
+
+    def test_unverified_file(self):
+        """Is an existing file without checksum replaced once?"""
+        filename = os.path.join(self.resources.name, "precomputed_v9.99.pkl")
+        url = f"{self.url}/precomputed_v9.99.pkl"
+        with open(filename, "wb") as f:
+            f.write(self.payload[:1000])
+
+        picker = Picker(search_paths=[], store=self.resources.name)
+        picker._install(url, filename)
+        picker._install(url, filename)
+        assert _CountingHandler.counts["/precomputed_v9.99.pkl"] == 1
+        with open(filename, "rb") as f:
+            assert f.read() == self.payload
+
+        # A file no longer matching its record is downloaded again.
+        with open(filename, "r+b") as f:
+            f.truncate(1000)
+        picker._install(url, filename)
+        assert _CountingHandler.counts["/precomputed_v9.99.pkl"] == 2
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# test_result_cache.py
+
+"""
+test_result_cache.py: unit tests for class result_cache.
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from pypahdb.observation import Observation
+from pypahdb.decomposer import Decomposer
+from pypahdb.result_cache import ResultCache
+
+
+class ResultCacheTestCase(unittest.TestCase):
+    """Unit tests for `result_cache.py`."""
+
+    def setUp(self):
+        import importlib_resources
+
+        file_name = "resources/sample_data_NGC7023.fits"
+        file_path = importlib_resources.files("pypahdb") / file_name
+        self.observation = Observation(file_path)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ResultCache(os.path.join(self.tmpdir.name, "results.sqlite"))
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def test_is_instance(self):
+        """Can we create an instance of ResultCache?"""
+        assert isinstance(self.cache, ResultCache)
+
+    def test_cache_hit(self):
+        """Are cached spectra reused instead of refitted?"""
+        first = Decomposer(self.observation.spectrum, version="3.20", cache=self.cache)
+        n_fitted = int(np.sum(first._mask))
+        assert self.cache.stats()["misses"] == n_fitted
+        assert self.cache.stats()["entries"] == n_fitted
+
+        second = Decomposer(self.observation.spectrum, version="3.20", cache=self.cache)
+        assert self.cache.stats()["hits"] == n_fitted
+        assert self.cache.stats()["hit_rate"] == 0.5
+        assert np.array_equal(first._weights, second._weights)
+
+    def test_duplicates(self):
+        """Are identical spectra fitted only once?"""
+        from specutils import Spectrum
+
+        spectrum = self.observation.spectrum
+        flux = spectrum.flux.copy()
+        flux[:, :, :] = flux[0, 0, :]
+        spectrum = Spectrum(flux=flux, spectral_axis=spectrum.spectral_axis)
+        decomposer = Decomposer(spectrum, version="3.20", cache=self.cache)
+
+        assert self.cache.stats()["misses"] == 1
+        assert self.cache.stats()["entries"] == 1
+        assert np.sum(decomposer.solve_time.value > 0) == 1
+        assert np.all(decomposer._weights == decomposer._weights[:, :1, :1])
+
+    def test_eviction(self):
+        """Are entries beyond the maximum count evicted?"""
+        self.cache.maxcount = 10
+        Decomposer(self.observation.spectrum, version="3.20", cache=self.cache)
+
+        assert self.cache.stats()["entries"] == 10
+        assert self.cache.stats()["evictions"] > 0
+
+
+if __name__ == "__main__":
+    unittest.main()
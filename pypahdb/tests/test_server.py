@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# test_server.py
+
+"""
+test_server.py: unit tests for class server.
+"""
+
+import json
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from http.client import HTTPConnection
+
+import numpy as np
+
+from pypahdb.decomposer import Decomposer
+from pypahdb.observation import Observation
+from pypahdb.server import DecompositionServer
+
+
+def _loads(data):
+    """Parse strict JSON, rejecting NaN and infinity."""
+
+    def _reject(constant):
+        raise ValueError(f"invalid JSON constant {constant}")
+
+    return json.loads(data, parse_constant=_reject)
+
+
+class _UnixHTTPConnection(HTTPConnection):
+    """HTTP connection over a Unix socket."""
+
+    def __init__(self, path):
+        super().__init__("localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class ServerTestCase(unittest.TestCase):
+    """Unit tests for `server.py`."""
+
+    def setUp(self):
+        import importlib_resources
+
+        file_name = "resources/sample_data_NGC7023.tbl"
+        file_path = importlib_resources.files("pypahdb") / file_name
+        self.spectrum = Observation(file_path).spectrum
+        self.body = json.dumps(
+            {
+                "spectral_axis": self.spectrum.spectral_axis.value.tolist(),
+                "spectral_axis_unit": str(self.spectrum.spectral_axis.unit),
+                "flux": self.spectrum.flux.value[0, 0].tolist(),
+                "flux_unit": str(self.spectrum.flux.unit),
+            }
+        )
+
+    def _post(self, connection, responses, body=None):
+        connection.request("POST", "/decompose", body=body or self.body)
+        response = connection.getresponse()
+        responses.append((response.status, _loads(response.read())))
+
+    def test_micro_batching(self):
+        """Are concurrent requests coalesced into batches?"""
+        server = DecompositionServer(
+            address=("127.0.0.1", 0), version="3.20", batch_window=0.5
+        )
+        server.start()
+        try:
+            responses = []
+            threads = [
+                threading.Thread(
+                    target=self._post,
+                    args=(HTTPConnection(*server.address), responses),
+                )
+                for _ in range(8)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            stats = server.stats()
+        finally:
+            server.shutdown()
+
+        expected = Decomposer(self.spectrum, version="3.20")
+        assert len(responses) == 8
+        for status, result in responses:
+            assert status == 200
+            assert np.isclose(result["nc"], expected.nc[0, 0].value)
+        assert stats["spectra"] == 8
+        assert stats["batches"] < 8
+
+    def test_isolation(self):
+        """Do bad requests in a batch fail without failing the others?"""
+        import astropy.units as u
+        from specutils import Spectrum
+
+        bad_unit = json.dumps(dict(json.loads(self.body), flux_unit="m"))
+        zero = dict(json.loads(self.body))
+        zero["flux"] = [0.0] * len(zero["flux"])
+        # Only fails in the batch, as it bypasses the checks of the handler.
+        bad_spectrum = Spectrum(
+            flux=self.spectrum.flux.value * u.m,
+            spectral_axis=self.spectrum.spectral_axis,
+        )
+
+        server = DecompositionServer(
+            address=("127.0.0.1", 0), version="3.20", batch_window=0.5
+        )
+        server.start()
+        errors = []
+
+        def _submit():
+            try:
+                server.submit(bad_spectrum)
+            except ValueError as e:
+                errors.append(e)
+
+        try:
+            responses = []
+            threads = [
+                threading.Thread(
+                    target=self._post,
+                    args=(HTTPConnection(*server.address), responses, body),
+                )
+                for body in 3 * [self.body] + [bad_unit, json.dumps(zero)]
+            ] + [threading.Thread(target=_submit)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            stats = server.stats()
+        finally:
+            server.shutdown()
+
+        statuses = sorted(status for status, _ in responses)
+        assert statuses == [200, 200, 200, 200, 400]
+        assert len(errors) == 1
+        assert stats["batches"] < 5
+        assert [r["error"] for _, r in responses].count(None) == 1
+
+    def test_unix_socket(self):
+        """Can we serve over a Unix socket?"""
+        tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmpdir.name, "pypahdb.sock")
+        server = DecompositionServer(address=path, version="3.20")
+        server.start()
+        try:
+            responses = []
+            self._post(_UnixHTTPConnection(path), responses)
+        finally:
+            server.shutdown()
+            tmpdir.cleanup()
+
+        assert responses[0][0] == 200
+        assert "cation" in responses[0][1]["charge_fractions"]
+
+    def test_backpressure(self):
+        """Are requests rejected when the queue is full?"""
+        server = DecompositionServer(
+            address=("127.0.0.1", 0), version="3.20", queue_depth=1
+        )
+        server._queue.put_nowait(None)
+        try:
+            self.assertRaises(queue.Full, server.submit, self.spectrum)
+            assert server.stats()["rejected"] == 1
+        finally:
+            server._httpd.server_close()
+
+    def test_matrix_lru(self):
+        """Are the least recently used matrices evicted?"""
+        import importlib_resources
+
+        file_path = importlib_resources.files("pypahdb") / "resources"
+        other = Observation(file_path / "sample_data_VV114E.tbl").spectrum
+        cube = Observation(file_path / "sample_data_NGC7023.fits").spectrum
+        server = DecompositionServer(
+            address=("127.0.0.1", 0), version="3.20", max_matrices=2
+        )
+        server.start()
+        try:
+            server.submit(self.spectrum)
+            first = next(iter(server._matrices))
+            server.submit(other)
+            server.submit(self.spectrum)
+            server.submit(cube)
+            assert len(server._matrices) == 2
+            assert first in server._matrices
+        finally:
+            server.shutdown()
+
+    def test_shutdown(self):
+        """Do queued requests fail on shutdown instead of hanging?"""
+        server = DecompositionServer(address=("127.0.0.1", 0), version="3.20")
+        threading.Thread(target=server._httpd.serve_forever, daemon=True).start()
+        errors = []
+
+        def _submit():
+            try:
+                server.submit(self.spectrum)
+            except RuntimeError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=_submit)
+        thread.start()
+        deadline = time.monotonic() + 10
+        while server._queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert not server._queue.empty()
+        server.shutdown()
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+        assert len(errors) == 1
+        self.assertRaises(RuntimeError, server.submit, self.spectrum)
+
+
+if __name__ == "__main__":
+    unittest.main()
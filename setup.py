@@ -178,11 +178,12 @@ setup(
     #
     # For example, the following would provide a command called `sample` which
     # executes the function `main` from this package when invoked:
-    # entry_points={  # Optional
-    #    'console_scripts': [
-    #        'sample=sample:main',
-    #    ],
-    # },
+    entry_points={  # Optional
+        'console_scripts': [
+            'pypahdb=pypahdb.cli:main',
+            'pypahdb-server=pypahdb.server:main',
+        ],
+    },
 
     # List additional URLs that are relevant to your project as a dict.
     #
@@ -199,7 +200,7 @@ setup(
         'Source': 'https://github.com/pahdb/pypahdb/',
     },
 
-    # Run custom commands
-    cmdclass={  # Optional
-    },
+    # Run custom commands; versioneer writes the resolved version into
+    # the built _version.py so that installs never need to run git.
+    cmdclass=versioneer.get_cmdclass(),  # Optional
 )